@@ -0,0 +1,107 @@
+"""Throughput benchmarks for the bot's hot path, run against fake_reddit.FakeReddit so no
+credentials or network are needed. Each stage runs on a freshly generated subreddit and
+reports comments per second, the API calls the real bot would have made and peak memory.
+
+    python benchmark.py --submissions 20 --comments 2000 --trigger-density 0.01
+"""
+import argparse
+import time
+import tracemalloc
+import content_matching
+from fake_reddit import FakeReddit
+from nippy_bot import NippyBot
+
+
+def make_bot(options):
+    reddit = FakeReddit(seed=options.seed)
+    reddit.generate_subreddit('Dota2', options.submissions, options.comments,
+                              max_depth=options.depth,
+                              trigger_density=options.trigger_density,
+                              chain_density=options.chain_density)
+    bot = NippyBot(subreddits_to_search='Dota2', db_file=':memory:', reddit=reddit,
+                   post_age_limit=24 * 60 * 60, fetch_workers=options.workers)
+    return bot, reddit
+
+
+def loaded_comments(bot):
+    comments = []
+    for submission in bot.reddit.submissions.values():
+        comments.extend(bot.get_comments(submission))
+    return comments
+
+
+def stage_get_submissions(bot):
+    return len(bot.get_submissions(hot=50, rising=15, controversial=15)), 0
+
+
+def stage_parse_comments(bot):
+    comments = loaded_comments(bot)
+    bot.reddit.calls.clear()
+    return 0, bot.parse_comments(comments, commit=True)[0]
+
+
+def stage_validate_comments(bot):
+    comments = loaded_comments(bot)
+    bot.comment_index = content_matching.CommentIndex(comments, bot.reddit)
+    matches, to_reply, checked, _ = bot.get_comments_to_reply(comments)
+    bot.reddit.calls.clear()
+    bot.validate_comments(to_reply, matches)
+    return 0, len(to_reply)
+
+
+def stage_parse_submissions(bot):
+    submissions = bot.get_submissions(hot=50, rising=15, controversial=15)
+    result = bot.parse_submissions(submissions)
+    return len(submissions), result[0]
+
+
+stages = [('get_submissions', stage_get_submissions),
+          ('parse_comments', stage_parse_comments),
+          ('validate_comments', stage_validate_comments),
+          ('parse_submissions', stage_parse_submissions)]
+
+
+def run_stage(func, options, trace_memory):
+    bot, reddit = make_bot(options)
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    submissions, comments = func(bot)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+    if trace_memory:
+        tracemalloc.stop()
+    calls = dict(reddit.calls)
+    bot.finish()
+    return elapsed, submissions, comments, calls, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--submissions', type=int, default=20)
+    parser.add_argument('--comments', type=int, default=1000, help='comments per submission')
+    parser.add_argument('--depth', type=int, default=10)
+    parser.add_argument('--trigger-density', type=float, default=0.01)
+    parser.add_argument('--chain-density', type=float, default=0.005)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stage', action='append', choices=[name for name, _ in stages])
+    options = parser.parse_args()
+
+    for name, func in stages:
+        if options.stage and name not in options.stage:
+            continue
+        # timings without tracemalloc (it slows allocation heavy code down a lot), memory from one extra run
+        elapsed, submissions, comments, calls, _ = min((run_stage(func, options, False) for _ in range(options.repeat)),
+                                                        key=lambda result: result[0])
+        peak = run_stage(func, options, True)[4]
+        rate = comments / elapsed if comments and elapsed else 0
+        print("{:<18} {:>9.3f}s {:>8} submissions {:>9} comments {:>12.0f} comments/s {:>8.1f} MiB peak".format(
+            name, elapsed, submissions, comments, rate, peak / 2 ** 20))
+        print("{:<18} {} API calls: {}".format('', sum(calls.values()),
+                                              ', '.join('{}={}'.format(k, v) for k, v in sorted(calls.items())) or '-'))
+
+
+if __name__ == '__main__':
+    main()
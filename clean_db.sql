@@ -1,2 +1,4 @@
 DELETE FROM comments;
 DELETE FROM to_reply;
+DELETE FROM submissions;
+DELETE FROM cycle;
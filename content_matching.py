@@ -1,5 +1,61 @@
-import praw
 import re
+import sys
+from collections import OrderedDict
+from functools import lru_cache
+
+_compile = lru_cache(maxsize=None)(re.compile)
+
+def compile_pattern(pattern, ignore_case=True):
+    if pattern is None or hasattr(pattern, 'search'):
+        return pattern
+    return _compile(pattern, re.IGNORECASE if ignore_case else 0)
+
+def match_regex(content, pattern, sanitizer=None, max_size=0, ignore_case=True):
+    if max_size > 0 and len(content) > max_size:
+        return None
+    match = compile_pattern(pattern, ignore_case).search(content)
+    if match:
+        if sanitizer:
+            return compile_pattern(sanitizer, False).sub('', match[0])
+        return match[0]
+    else:
+        return None
+
+def match_any(content, matchers):
+    # the leftmost match of any of the (pattern, sanitizer, max_size) matchers, cleaned up by its own sanitizer
+    best = None
+    for pattern, sanitizer, max_size in matchers:
+        if max_size > 0 and len(content) > max_size:
+            continue
+        match = compile_pattern(pattern).search(content)
+        if match and (best is None or match.start() < best[0].start()):
+            best = (match, sanitizer)
+    if best is None:
+        return None
+    match, sanitizer = best
+    if sanitizer:
+        return compile_pattern(sanitizer, False).sub('', match[0])
+    return match[0]
+
+def match_submission(submission, comment_matchers, submission_matchers):
+    # submission_matchers are the lists of (pattern, sanitizer, max_size) for self text, title and link of rules.RulePack
+    if not any(comment_matchers.accepts(text) for text in (submission.title, submission.selftext, submission.url)):
+        return None
+    if submission.is_self:
+        result = match_any(submission.selftext, submission_matchers[0])
+        if result:
+            return result
+    result1 = match_any(submission.title, submission_matchers[1])
+    result2 = None
+
+    if not submission.is_self:
+        result2 = match_any(submission.url, submission_matchers[2])
+
+    if result1 and result2: #if post has a match on title and links to it, don't reply
+        return None
+    if result1:
+        return result1
+    return result2
 
 class ContentMatch:
     def next(self):
@@ -38,11 +94,128 @@ class SubmissionContent(ContentMatch):
     def reset(self):
         self.index = -1
 
+class CommentRecord:
+    """The parts of a comment the bot uses, copied out of a praw Comment so the comment
+    tree, its Redditor objects and the reddit reference can be released as soon as a
+    thread is converted. The permalink is built locally instead of being fetched."""
+    __slots__ = ('id', 'parent_id', 'link_id', 'author_name', 'body', 'is_root', 'created_utc', 'subreddit')
+
+    def __init__(self, id, parent_id, link_id, author_name, body, created_utc, subreddit):
+        self.id = id
+        self.parent_id = parent_id
+        # shared by every comment of the thread, one copy is enough
+        self.link_id = sys.intern(link_id)
+        self.author_name = author_name
+        self.body = body
+        self.is_root = parent_id.startswith('t3_')
+        self.created_utc = created_utc
+        self.subreddit = sys.intern(subreddit)
+
+    @classmethod
+    def from_comment(cls, comment):
+        author = comment.author
+        return cls(comment.id, comment.parent_id, comment.link_id, author.name if author is not None else None,
+                   comment.body, comment.created_utc, comment.subreddit.display_name)
+
+    @property
+    def name(self):
+        return 't1_' + self.id
+
+    def permalink(self):
+        return '/r/{}/comments/{}/_/{}/'.format(self.subreddit, self.link_id[3:], self.id)
+
+    # equal by ID like praw's objects, a comment loaded twice is still the same comment
+    def __eq__(self, other):
+        return isinstance(other, CommentRecord) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+def subreddit_name(thing):
+    # for praw objects and CommentRecords alike
+    if isinstance(thing, CommentRecord):
+        return thing.subreddit
+    return thing.subreddit.display_name
+
+class CommentIndex:
+    """Comments of a thread keyed by fullname, so parents can be resolved from the
+    already loaded tree instead of a lazy fetch. Misses are loaded with reddit.info when
+    the index has a reddit instance and fall back to comment.parent() otherwise."""
+    def __init__(self, comments=(), reddit=None):
+        self.comments = {}
+        self.reddit = reddit
+        self.hits, self.misses = 0, 0
+        self.add_all(comments)
+
+    def add(self, comment):
+        self.comments[comment.name] = comment
+
+    def add_all(self, comments):
+        for comment in comments:
+            self.add(comment)
+
+    def get(self, fullname):
+        return self.comments.get(fullname)
+
+    def resolve(self, fullnames, batch_size=100):
+        # comments that aren't in the index yet are loaded with reddit.info, batch_size per request
+        if self.reddit is None:
+            return 0
+        missing = [name for name in dict.fromkeys(fullnames) if name.startswith('t1_') and name not in self.comments]
+        for start in range(0, len(missing), batch_size):
+            self.add_all(CommentRecord.from_comment(comment)
+                         for comment in self.reddit.info(fullnames=missing[start:start + batch_size]))
+        return len(missing)
+
+    def parent(self, comment):
+        # None for a root comment or a parent Reddit no longer has, when the index has a reddit instance
+        parent = self.comments.get(comment.parent_id)
+        if parent is not None:
+            self.hits += 1
+            return parent
+        self.misses += 1
+        if self.reddit is not None:
+            self.resolve([comment.parent_id])
+            return self.comments.get(comment.parent_id)
+        parent = comment.parent()
+        if not comment.is_root:
+            self.add(parent)
+        return parent
+
+class MatchCache:
+    """Match results by (ID, rule pack version), no match included, so a comment that comes
+    up again as a parent or a reply is not matched twice. Least recently used results are
+    dropped past max_size, a new rule pack version misses on every key."""
+    missing = object()
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.results = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key, compute):
+        result = self.results.get(key, self.missing)
+        if result is not self.missing:
+            self.hits += 1
+            self.results.move_to_end(key)
+            return result
+        self.misses += 1
+        result = compute()
+        self.results[key] = result
+        if len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+        return result
+
+    def clear(self):
+        self.results.clear()
+
+
 class CommentContent(ContentMatch):
-    def __init__(self, comment):
+    def __init__(self, comment, index=None):
         self.comment = comment
         self.current_comment = comment
         self.started = False
+        self.index = index
 
     def has_next(self):
         return not self.started or not self.current_comment.is_root
@@ -51,7 +224,13 @@ class CommentContent(ContentMatch):
         if self.started:
             if self.current_comment.is_root:
                 return None
-            self.current_comment = self.current_comment.parent()
+            if self.index is not None:
+                parent = self.index.parent(self.current_comment)
+            else:
+                parent = self.current_comment.parent()
+            if parent is None:
+                return None
+            self.current_comment = parent
         else:
             self.started = True
             self.current_comment = self.comment
@@ -67,8 +246,10 @@ class CommentContent(ContentMatch):
 class ContentMatcher:
     #pattern should be a tuple with the pattern to match, the sanitizer string (None for no sanitizing), and max_size (0 for no max)
     def __init__(self, patterns, ignore_case=True):
-        self.patterns = patterns
         self.ignore_case = ignore_case
+        # patterns and sanitizers are compiled once here instead of on every search
+        self.patterns = [(compile_pattern(pattern, ignore_case), compile_pattern(sanitizer, False), max_size)
+                         for pattern, sanitizer, max_size in patterns]
 
     def match(self, content):
         n = content.next()
@@ -80,10 +261,9 @@ class ContentMatcher:
                 return [(self.sanitize(match, sanitizer), content.current())]
 
     def match_with_pattern(self, content, pattern, max_size):
-        flags = re.IGNORECASE if self.ignore_case else 0
         if max_size > 0 and len(content) > max_size:
             return None
-        match = re.search(pattern, content, flags)
+        match = compile_pattern(pattern, self.ignore_case).search(content)
         if match:
             return match[0]
         else:
@@ -91,16 +271,12 @@ class ContentMatcher:
 
     def sanitize(self, string, sanitizer=None):
         if sanitizer:
-            return re.sub(sanitizer, '', string)
+            return compile_pattern(sanitizer, False).sub('', string)
         else:
             return string
 
 
 class ChainContentMatcher(ContentMatcher):
-    def __init__(self, patterns, ignore_case=True):
-        self.patterns = patterns
-        self.ignore_case = ignore_case
-
     def match(self, content):
         result = []
         for pattern, sanitizer, max_size in self.patterns:
@@ -113,3 +289,185 @@ class ChainContentMatcher(ContentMatcher):
             else: # cancel search because one of the contents does not match
                 return None
         return result
+
+
+class MatcherSet:
+    """Runs several matchers over the same content, first match wins.
+
+    literals are case-folded substrings of which at least one has to be present in
+    the content's own text for any of the matchers to be able to match, so most
+    contents get rejected with a plain substring check before any regex runs."""
+    def __init__(self, matchers, literals=None):
+        self.matchers = matchers
+        self.literals = [literal.casefold() for literal in literals] if literals else []
+
+    def accepts(self, text):
+        if not self.literals:
+            return True
+        if not text:
+            return False
+        folded = text.casefold()
+        return any(literal in folded for literal in self.literals)
+
+    def match(self, content, chains=None):
+        return self.first_match(self.matchers, content, chains)
+
+    def first_match(self, matchers, content, chains=None):
+        # chains holds the results of a ChainAnalyzer for this content, chain matchers are looked up instead of walked
+        for matcher in matchers:
+            if chains is not None and isinstance(matcher, ChainContentMatcher):
+                result = chains.get(matcher)
+            else:
+                content.reset()
+                result = matcher.match(content)
+            if result:
+                return result
+        return None
+
+
+class IndexedMatcherSet(MatcherSet):
+    """MatcherSet for many rules. Every matcher is keyed by the literals its own text has
+    to contain; one regex pass over the text finds the literals present and only the
+    matchers keyed by them run, in their original order. keyed_matchers is a list of
+    (matcher, literals) pairs."""
+    def __init__(self, keyed_matchers):
+        self.matchers = [matcher for matcher, _ in keyed_matchers]
+        self.keys = {}
+        for position, (_, literals) in enumerate(keyed_matchers):
+            for literal in literals:
+                self.keys.setdefault(literal.casefold(), []).append(position)
+        # longest first, so a literal found at a position hides only literals that are its own prefixes
+        literals = sorted(self.keys, key=len, reverse=True)
+        self.prefixes = {literal: [other for other in literals if literal.startswith(other)] for literal in literals}
+        alternatives = '|'.join(re.escape(literal) for literal in literals)
+        self.literal_pattern = re.compile('(?=({}))'.format(alternatives), re.IGNORECASE) if literals else None
+        self.last_text, self.last_candidates = None, []
+
+    def candidates(self, text):
+        if text is self.last_text:
+            return self.last_candidates
+        positions = set()
+        if text and self.literal_pattern is not None:
+            for found in {match[1].casefold() for match in self.literal_pattern.finditer(text)}:
+                for literal in self.prefixes[found]:
+                    positions.update(self.keys[literal])
+        self.last_text, self.last_candidates = text, [self.matchers[position] for position in sorted(positions)]
+        return self.last_candidates
+
+    def accepts(self, text):
+        return bool(self.candidates(text))
+
+    def match(self, content, chains=None):
+        content.reset()
+        return self.first_match(self.candidates(content.next()), content, chains)
+
+
+class ChainAnalyzer:
+    """Finds every completed reply chain of a thread in one pass from the roots down,
+    instead of walking the ancestors of each comment. A comment's state is the set of
+    chain levels it continues: level k is kept when the comment matches the k-th pattern
+    of the chain and its parent kept level k + 1 (the last level needs no parent), and
+    the chain is complete on a comment that keeps level 0."""
+    def __init__(self, matchers):
+        self.matchers = [matcher for matcher in matchers if isinstance(matcher, ChainContentMatcher)]
+        sizes = [max_size for matcher in self.matchers for _, _, max_size in matcher.patterns]
+        # no chain level can match a comment longer than this, 0 when some level has no limit
+        self.max_size = max(sizes) if sizes and all(sizes) else 0
+        # how many ancestors the longest chain looks at
+        self.depth = max((len(matcher.patterns) - 1 for matcher in self.matchers), default=0)
+
+    def analyze(self, comments):
+        by_name = {comment.name: comment for comment in comments}
+        states, unknown = {}, set()
+        analysis = ThreadChains()
+        for comment in comments:
+            # climb until an ancestor with a known state, then resolve the ones in between top down;
+            # comments too long for any level are known to be empty without looking at their parents
+            pending, current, base = [], comment, None
+            while True:
+                if current.name in states:
+                    base = states[current.name]
+                    break
+                if current.name in unknown:
+                    unknown.update(c.name for c in pending)
+                    pending = None
+                    break
+                if not self.may_match(current):
+                    states[current.name] = base = None
+                    break
+                pending.append(current)
+                if current.is_root:
+                    break
+                parent = by_name.get(current.parent_id)
+                if parent is None:
+                    # the parent wasn't loaded, which only matters when this comment continues a chain level;
+                    # then it's reported in missing so the caller can load it, and until it is these comments
+                    # fall back to walking their parents
+                    if self.needs_parent(current):
+                        analysis.missing.add(current.parent_id)
+                        unknown.update(c.name for c in pending)
+                        pending = None
+                    break
+                current = parent
+            for current in reversed(pending or []):
+                states[current.name] = base = self.state(current, base)
+            if comment.name in states:
+                state = states[comment.name]
+                analysis.add(comment, {matcher: levels[0] for matcher, levels in state.items() if 0 in levels} if state else None)
+        return analysis
+
+    def may_match(self, comment):
+        return bool(comment.body) and not (self.max_size and len(comment.body) > self.max_size)
+
+    def needs_parent(self, comment):
+        # whether the comment matches a level that has to be continued by its parent
+        return any(matcher.match_with_pattern(comment.body, pattern, max_size)
+                   for matcher in self.matchers for pattern, _, max_size in matcher.patterns[:-1])
+
+    def may_be_ancestor(self, comment):
+        # whether the comment matches a level past the first, i.e. could be the parent of a chain link
+        return self.may_match(comment) and any(matcher.match_with_pattern(comment.body, pattern, max_size)
+                                                for matcher in self.matchers for pattern, _, max_size in matcher.patterns[1:])
+
+    def state(self, comment, parent_state):
+        state = {}
+        for matcher in self.matchers:
+            levels = self.levels(matcher, comment, parent_state.get(matcher) if parent_state else None)
+            if levels:
+                state[matcher] = levels
+        return state or None
+
+    def levels(self, matcher, comment, parent_levels):
+        # level -> [(match, comment), ...] for this comment and the ancestors that continue it
+        levels = {}
+        last = len(matcher.patterns) - 1
+        for level, (pattern, sanitizer, max_size) in enumerate(matcher.patterns):
+            if level < last and not (parent_levels and level + 1 in parent_levels):
+                continue
+            match = matcher.match_with_pattern(comment.body, pattern, max_size)
+            if match:
+                found = (matcher.sanitize(match, sanitizer), comment)
+                levels[level] = [found] + (parent_levels[level + 1] if level < last else [])
+        return levels
+
+
+class ThreadChains:
+    def __init__(self):
+        self.analyzed = set()
+        self.results = {}
+        # fullnames of parents that weren't loaded but are needed to finish some chain
+        self.missing = set()
+
+    def add(self, comment, completions):
+        self.analyzed.add(comment.name)
+        if completions:
+            self.results[comment.name] = completions
+
+    def get(self, comment):
+        # {chain matcher: result} for an analyzed comment, None when the comment wasn't analyzed
+        if comment.name not in self.analyzed:
+            return None
+        return self.results.get(comment.name, {})
+
+    def completions(self):
+        return [(name, result) for name, found in self.results.items() for result in found.values()]
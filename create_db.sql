@@ -9,3 +9,10 @@ CREATE TABLE IF NOT EXISTS to_reply (
     ID VARCHAR(10) PRIMARY KEY NOT NULL,
     RESPONSE VARCHAR(50) NOT NULL
 );
+
+CREATE TABLE IF NOT EXISTS submissions (
+    ID VARCHAR(10) PRIMARY KEY NOT NULL,
+    NUM_COMMENTS INTEGER NOT NULL DEFAULT 0,
+    NEWEST_COMMENT INTEGER NOT NULL DEFAULT 0,
+    LAST_SCANNED INTEGER NOT NULL
+);
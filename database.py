@@ -0,0 +1,239 @@
+import array
+import bisect
+import mmap
+import os
+import sqlite3
+import tempfile
+import time
+
+# schema changes after create_db.sql (version 1), PRAGMA user_version holds the last one applied
+migrations = [
+    # 2: index for age based pruning, key/value table for maintenance bookkeeping, incremental vacuum
+    """
+    CREATE INDEX IF NOT EXISTS comments_date_added ON comments (DATE_ADDED);
+    CREATE TABLE IF NOT EXISTS meta (
+        KEY VARCHAR(30) PRIMARY KEY NOT NULL,
+        VALUE INTEGER NOT NULL
+    );
+    PRAGMA auto_vacuum = INCREMENTAL;
+    VACUUM;
+    """,
+    # 3: retry bookkeeping for the reply queue
+    """
+    ALTER TABLE to_reply ADD COLUMN CREATED INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE to_reply ADD COLUMN ATTEMPTS INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE to_reply ADD COLUMN NEXT_ATTEMPT INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE to_reply ADD COLUMN LAST_ERROR TEXT;
+    CREATE INDEX IF NOT EXISTS to_reply_next_attempt ON to_reply (NEXT_ATTEMPT);
+    """,
+    # 4: reply claims shared by worker processes
+    """
+    CREATE TABLE IF NOT EXISTS claims (
+        ID VARCHAR(10) PRIMARY KEY NOT NULL,
+        WORKER VARCHAR(30) NOT NULL,
+        CLAIMED_AT INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS claims_claimed_at ON claims (CLAIMED_AT);
+    """,
+    # 5: the bot's own replies and their score history, for the low score sweep (sweeper.py)
+    """
+    CREATE TABLE IF NOT EXISTS replies (
+        ID VARCHAR(10) PRIMARY KEY NOT NULL,
+        PARENT_ID VARCHAR(12) NOT NULL,
+        SUBREDDIT VARCHAR(30) NOT NULL,
+        CREATED INTEGER NOT NULL,
+        SCORE INTEGER NOT NULL DEFAULT 1,
+        LAST_CHECKED INTEGER NOT NULL DEFAULT 0,
+        NEXT_CHECK INTEGER NOT NULL DEFAULT 0,
+        DELETED BOOL NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS replies_next_check ON replies (NEXT_CHECK);
+    CREATE TABLE IF NOT EXISTS reply_scores (
+        ID VARCHAR(10) NOT NULL,
+        CHECKED_AT INTEGER NOT NULL,
+        SCORE INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS reply_scores_id ON reply_scores (ID);
+    """,
+    # 6: submissions each worker's current cycle still has to scan, so an interrupted cycle can be resumed
+    """
+    CREATE TABLE IF NOT EXISTS cycle (
+        WORKER VARCHAR(30) NOT NULL,
+        POSITION INTEGER NOT NULL,
+        ID VARCHAR(12) NOT NULL,
+        PRIMARY KEY (WORKER, POSITION)
+    );
+    """,
+    # 7: when a cycle cursor was written, cursors that missed a whole cycle are dropped instead of resumed
+    """
+    ALTER TABLE cycle ADD COLUMN STARTED INTEGER NOT NULL DEFAULT 0;
+    """,
+]
+
+select_meta = 'SELECT VALUE FROM meta WHERE KEY = ?'
+insert_meta = 'INSERT OR REPLACE INTO meta (KEY, VALUE) VALUES (?, ?)'
+delete_old_comments = 'DELETE FROM comments WHERE DATE_ADDED < ?'
+delete_old_submissions = 'DELETE FROM submissions WHERE LAST_SCANNED < ?'
+delete_old_claims = 'DELETE FROM claims WHERE CLAIMED_AT < ?'
+insert_claim = 'INSERT OR IGNORE INTO claims (ID, WORKER, CLAIMED_AT) VALUES (?, ?, ?)'
+select_claim = 'SELECT WORKER FROM claims WHERE ID = ?'
+release_claim = 'DELETE FROM claims WHERE ID = ? AND WORKER = ?'
+
+
+# schema_version() of a database with every migration applied
+latest_version = len(migrations) + 1
+
+
+def connect(filename, timeout=30):
+    # WAL lets readers (e.g. a stats script) run while the bot writes, and NORMAL only syncs at checkpoints
+    connection = sqlite3.connect(filename, timeout=timeout)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+def schema_version(connection):
+    return connection.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(connection, creation_script):
+    version = schema_version(connection)
+    if version < 1:
+        connection.executescript(creation_script)
+        connection.execute('PRAGMA user_version = 1')
+        version = 1
+    for number, script in enumerate(migrations[version - 1:], start=version + 1):
+        connection.executescript(script)
+        connection.execute('PRAGMA user_version = {}'.format(number))
+    connection.commit()
+
+
+def get_meta(connection, key, default=None):
+    row = connection.execute(select_meta, [key]).fetchone()
+    return default if row is None else row[0]
+
+
+def set_meta(connection, key, value):
+    with connection:
+        connection.execute(insert_meta, [key, value])
+
+
+def claim(connection, thing_id, worker):
+    # the first worker to insert the ID owns it, the insert and the check run in one write transaction
+    with connection:
+        connection.execute(insert_claim, [thing_id, worker, int(time.time())])
+        owner = connection.execute(select_claim, [thing_id]).fetchone()
+    return owner is not None and owner[0] == worker
+
+
+def prune(connection, before, vacuum_pages=500):
+    # drops log rows older than before (a timestamp) and gives a bounded number of free pages back to the filesystem
+    with connection:
+        comments = connection.execute(delete_old_comments, [before]).rowcount
+        connection.execute(delete_old_submissions, [before])
+        connection.execute(delete_old_claims, [before])
+    # the pragma frees one page per step, executescript steps it to the end
+    connection.executescript('PRAGMA incremental_vacuum({});'.format(int(vacuum_pages)))
+    return comments
+
+
+class WriteBuffer:
+    """Collects writes to the log tables and sends them to the database on flush(),
+    consecutive rows for the same statement go through a single executemany and the
+    whole batch is committed as one transaction."""
+    def __init__(self, connection):
+        self.connection = connection
+        self.pending = []
+
+    def __len__(self):
+        return sum(len(rows) for _, rows in self.pending)
+
+    def add(self, sql, params):
+        if self.pending and self.pending[-1][0] == sql:
+            self.pending[-1][1].append(params)
+        else:
+            self.pending.append((sql, [params]))
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        with self.connection:
+            for sql, rows in pending:
+                self.connection.executemany(sql, rows)
+
+
+def thing_key(thing_id):
+    # comment IDs and submission fullnames as one integer each, the last bit tells them apart
+    if thing_id.startswith('t3_'):
+        return int(thing_id[3:], 36) << 1 | 1
+    return int(thing_id, 36) << 1
+
+
+class SeenIds:
+    """Set of the logged comment IDs and submission fullnames. Most of them come from a
+    snapshot file of sorted 64 bit keys (thing_key) that is memory mapped and searched
+    with bisect, so a run knows every recent ID right away without reading them from the
+    database; IDs added since are kept in a normal set. save() writes both back."""
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.recent = set()
+        self.file, self.map, self.keys = None, None, []
+        self.open()
+
+    def open(self):
+        if self.filename and os.path.exists(self.filename) and os.path.getsize(self.filename):
+            self.file = open(self.filename, 'rb')
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.keys = memoryview(self.map).cast('Q')
+
+    def __contains__(self, thing_id):
+        if thing_id in self.recent:
+            return True
+        key = thing_key(thing_id)
+        index = bisect.bisect_left(self.keys, key)
+        return index < len(self.keys) and self.keys[index] == key
+
+    def __len__(self):
+        return len(self.keys) + len(self.recent)
+
+    def __rand__(self, ids):
+        return {thing_id for thing_id in ids if thing_id in self}
+
+    def add(self, thing_id):
+        self.recent.add(thing_id)
+
+    def update(self, ids):
+        self.recent.update(ids)
+
+    def clear(self):
+        # forgets everything, the snapshot file included
+        self.close()
+        self.recent = set()
+        if self.filename and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def close(self):
+        if self.map is not None:
+            self.keys.release()
+            self.map.close()
+            self.file.close()
+            self.file, self.map, self.keys = None, None, []
+
+    def save(self):
+        if not self.filename:
+            return
+        keys = array.array('Q', self.keys)
+        keys.extend(thing_key(thing_id) for thing_id in self.recent)
+        keys = array.array('Q', sorted(set(keys)))
+        self.close()
+        # a temp file of this process's own, supervisor workers save at the same time
+        directory, name = os.path.split(self.filename)
+        fd, temp = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                keys.tofile(f)
+            os.replace(temp, self.filename)
+        except BaseException:
+            os.remove(temp)
+            raise
+        self.recent = set()
+        self.open()
@@ -0,0 +1,154 @@
+import re
+import time
+
+insert_queued_reply = 'INSERT OR IGNORE INTO to_reply (ID, RESPONSE, CREATED, ATTEMPTS, NEXT_ATTEMPT) VALUES (?, ?, ?, 0, 0)'
+select_due_replies = 'SELECT ID, RESPONSE, CREATED, ATTEMPTS FROM to_reply WHERE NEXT_ATTEMPT <= ? ORDER BY CREATED DESC'
+requeue_failed_reply = ('INSERT OR REPLACE INTO to_reply (ID, RESPONSE, CREATED, ATTEMPTS, NEXT_ATTEMPT, LAST_ERROR) '
+                        'VALUES (?, ?, ?, ?, ?, ?)')
+delete_queued_reply = 'DELETE FROM to_reply WHERE ID = ?'
+count_queued_replies = 'SELECT COUNT(*) FROM to_reply'
+
+rate_limit_message = re.compile(r'(\d+) (second|minute)', re.IGNORECASE)
+
+
+def api_error():
+    # praw is imported with the Reddit instance instead of at startup, and an except clause
+    # is only evaluated once something was raised. prawcore's errors (timeouts, 5xx) aren't
+    # wrapped by praw, a reply that failed with one is queued like any other failure
+    import praw.exceptions
+    import prawcore.exceptions
+    return praw.exceptions.PRAWException, prawcore.exceptions.PrawcoreException
+
+
+def rate_limit_delay(exception):
+    # seconds Reddit asked us to wait in a RATELIMIT error, None for any other error
+    message = str(exception)
+    if 'RATELIMIT' not in message.upper() and 'DOING THAT TOO MUCH' not in message.upper():
+        return None
+    match = rate_limit_message.search(message)
+    if not match:
+        return 60
+    return int(match[1]) * (60 if match[2].lower() == 'minute' else 1)
+
+
+class TokenBucket:
+    """Request budget that refills at rate tokens per second up to capacity. When the
+    Reddit instance is given, the bucket is synced with the rate limit headers praw
+    keeps in reddit.auth.limits, so it never spends more than Reddit still allows."""
+    def __init__(self, capacity=10, rate=1.0, reddit=None):
+        self.capacity = capacity
+        self.rate = rate
+        self.reddit = reddit
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.paused_until = 0
+
+    def sync(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        limits = getattr(getattr(self.reddit, 'auth', None), 'limits', None) or {}
+        remaining, reset = limits.get('remaining'), limits.get('reset_timestamp')
+        if remaining is not None:
+            self.tokens = min(self.tokens, remaining)
+            if reset is not None and reset > now:
+                self.rate = remaining / (reset - now)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def acquire(self):
+        now = time.time()
+        if now < self.paused_until:
+            return False
+        self.sync(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class ReplyDispatcher:
+    """Persisted queue of replies that couldn't be sent right away, to comments (by ID) and
+    submissions (by fullname). Pending replies are retried freshest first, failures back off
+    exponentially per item and are dropped after max_attempts or once the comment or
+    submission is older than max_age."""
+    def __init__(self, bot, bucket=None, max_attempts=5, base_delay=60, max_age=None):
+        self.bot = bot
+        self.bucket = bucket if bucket is not None else TokenBucket(reddit=bot.reddit)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_age = max_age if max_age is not None else bot.post_age_limit
+
+    def can_send(self):
+        return self.bot.dry_run or self.bucket.acquire()
+
+    def enqueue(self, thing, reply):
+        # a comment is queued by its ID, a submission by its fullname
+        thing_id = thing.name if thing.name.startswith('t3_') else thing.id
+        self.bot.writer.add(insert_queued_reply, [thing_id, reply, int(thing.created_utc)])
+
+    def queue_size(self):
+        return self.bot.connection.execute(count_queued_replies).fetchone()[0]
+
+    def drop(self, thing_id):
+        self.bot.writer.add(delete_queued_reply, [thing_id])
+
+    def retry_later(self, thing_id, response, created, attempts, error):
+        # (re)inserts the row, dispatch() takes it off the queue before sending
+        if attempts >= self.max_attempts:
+            self.drop(thing_id)
+            return
+        next_attempt = time.time() + self.base_delay * 2 ** (attempts - 1)
+        self.bot.writer.add(requeue_failed_reply, [thing_id, response, created, attempts, int(next_attempt), str(error)])
+
+    def dispatch(self):
+        self.bot.flush()
+        now = time.time()
+        queued = self.bot.connection.execute(select_due_replies, [int(now)]).fetchall()
+        replied = set()
+        expired = {comment_id for comment_id, _, created, _ in queued if created and created < now - self.max_age}
+        for comment_id in expired:
+            self.drop(comment_id)
+        queued = [item for item in queued if item[0] not in expired]
+        # the queued comments and submissions are loaded together, 100 per request, instead of one request each
+        self.bot.resolve('t1_' + item[0] for item in queued if not item[0].startswith('t3_'))
+        fullnames = [item[0] for item in queued if item[0].startswith('t3_')]
+        submissions = {submission.name: submission for submission in self.bot.reddit.info(fullnames=fullnames)} if fullnames else {}
+        for thing_id, response, created, attempts in queued:
+            if not self.bot.claim(thing_id):
+                # another worker's dispatcher is sending it
+                continue
+            if not self.can_send():
+                self.bot.release(thing_id)
+                break
+            is_submission = thing_id.startswith('t3_')
+            thing = submissions.get(thing_id) if is_submission else self.bot.comment_index.get('t1_' + thing_id)
+            if thing is None:
+                # Reddit didn't return it, the comment or submission is gone
+                self.retry_later(thing_id, response, created, attempts + 1, 'not found')
+                self.bot.release(thing_id)
+                continue
+            # off the queue and logged before sending, after a crash mid-send it's not sent a second time.
+            # The row is only marked valid once the reply went out
+            self.drop(thing_id)
+            if is_submission:
+                self.bot.log_submission(thing, False)
+            else:
+                self.bot.log_comment(thing, False)
+            self.bot.flush()
+            try:
+                if is_submission:
+                    self.bot.reply_to_submission(thing, response)
+                else:
+                    self.bot.reply_to_comment(thing, response)
+                self.bot.log_sent(thing_id)
+                replied.add(thing)
+            except api_error() as e:
+                self.retry_later(thing_id, response, created, attempts + 1, e)
+                self.bot.release(thing_id)
+                delay = rate_limit_delay(e)
+                if delay is not None:
+                    self.bucket.pause(delay)
+                    break
+        self.bot.flush()
+        return replied
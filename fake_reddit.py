@@ -0,0 +1,312 @@
+"""Offline stand-in for the parts of praw.Reddit the bot uses, for benchmarks and dry runs
+without credentials. Every call that would be an HTTP request on the real object is
+counted in FakeReddit.calls by endpoint."""
+import itertools
+import random
+import time
+from collections import Counter
+
+words = ["the", "game", "patch", "hero", "carry", "support", "gg", "wp", "mid", "lane",
+         "report", "this", "is", "so", "good", "bad", "lol", "when", "valve", "pls"]
+triggers = ["Brutal. Savage. Rekt.", "Nippy, Kind, Langur", "https://gfycat.com/BrutalSavageRekt",
+            "gfycat.com/NippyKindLangur"]
+chains = [["Brutal", "Savage", "Rekt"], ["Nippy", "Kind", "Langur"]]
+
+
+def base36(number):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while True:
+        number, digit = divmod(number, 36)
+        result = digits[digit] + result
+        if number == 0:
+            return result
+
+
+class FakeRedditor:
+    def __init__(self, reddit, name):
+        self.reddit = reddit
+        self.name = name
+        self.comments = FakeListing(reddit, 'user_comments', lambda: sorted(
+            (c for c in reddit.comments_by_id.values() if c.author and c.author.name == name),
+            key=lambda c: c.created_utc, reverse=True))
+
+
+class FakeUser:
+    def __init__(self, reddit, name):
+        self.reddit = reddit
+        self.name = name
+
+    def me(self):
+        self.reddit.request('me')
+        return self.reddit.redditor(self.name)
+
+
+class FakeAuth:
+    def __init__(self):
+        self.limits = {'remaining': None, 'reset_timestamp': None, 'used': None}
+
+
+class FakeListing:
+    def __init__(self, reddit, endpoint, items):
+        self.reddit = reddit
+        self.endpoint = endpoint
+        self.items = items
+
+    def new(self, limit=100):
+        return self.reddit.paginate(self.endpoint, self.items(), limit)
+
+
+class FakeComment:
+    def __init__(self, reddit, id, submission, parent_id, body, author, created_utc, score=1):
+        self.reddit = reddit
+        self.id = id
+        self.name = 't1_' + id
+        self.submission = submission
+        self.link_id = submission.name
+        self.parent_id = parent_id
+        self.body = body
+        self.author = author
+        self.created_utc = created_utc
+        self.score = score
+        self.subreddit = submission.subreddit
+        self.replies = []
+
+    @property
+    def is_root(self):
+        return self.parent_id.startswith('t3_')
+
+    def parent(self):
+        if self.is_root:
+            return self.submission
+        # like praw, parents are free when the thread was loaded and a request otherwise
+        if not self.submission.loaded:
+            self.reddit.request('comment')
+        return self.reddit.comments_by_id[self.parent_id[3:]]
+
+    def permalink(self, fast=False):
+        return '/r/{}/comments/{}/_/{}/'.format(self.subreddit.display_name, self.submission.id, self.id)
+
+    def reply(self, body):
+        self.reddit.request('reply')
+        return self.reddit.add_comment(self.submission, self.name, body, self.reddit.username)
+
+    def delete(self):
+        self.reddit.request('delete')
+        self.body = '[deleted]'
+        self.author = None
+
+
+class FakeCommentForest:
+    def __init__(self, submission):
+        self.submission = submission
+
+    def replace_more(self, limit=32, threshold=0):
+        # the first page holds about 200 comments, each "load more" returns up to 100 more
+        hidden = max(0, len(self.submission.all_comments) - 200)
+        for _ in range((hidden + 99) // 100):
+            self.submission.reddit.request('morechildren')
+        return []
+
+    def list(self):
+        return list(self.submission.all_comments)
+
+
+class FakeSubmission:
+    def __init__(self, reddit, id, subreddit, title, created_utc, selftext='', url=None, author=None):
+        self.reddit = reddit
+        self.id = id
+        self.name = 't3_' + id
+        self.subreddit = subreddit
+        self.title = title
+        self.selftext = selftext
+        self.is_self = url is None
+        self.url = url if url is not None else 'https://www.reddit.com/r/{}/comments/{}/'.format(subreddit.display_name, id)
+        self.permalink = '/r/{}/comments/{}/_/'.format(subreddit.display_name, id)
+        self.created_utc = created_utc
+        self.author = author
+        self.all_comments = []
+        self.loaded = False
+
+    @property
+    def num_comments(self):
+        return len(self.all_comments)
+
+    @property
+    def comments(self):
+        if not self.loaded:
+            self.reddit.request('comments')
+            self.loaded = True
+        return FakeCommentForest(self)
+
+    def reply(self, body):
+        self.reddit.request('reply')
+        return self.reddit.add_comment(self, self.name, body, self.reddit.username)
+
+
+class FakeStream:
+    def __init__(self, reddit, endpoint, items):
+        self.reddit = reddit
+        self.endpoint = endpoint
+        self.items = items
+
+    def stream(self, pause_after=None, skip_existing=False):
+        seen = set()
+        while True:
+            self.reddit.request(self.endpoint)
+            new = [item for item in reversed(self.items()[:100]) if item.name not in seen]
+            for item in new:
+                seen.add(item.name)
+                yield item
+            if not new:
+                if pause_after is None:
+                    return
+                yield None
+
+    def comments(self, pause_after=None, skip_existing=False):
+        return self.stream(pause_after, skip_existing)
+
+    submissions = comments
+
+
+class FakeSubreddit:
+    def __init__(self, reddit, names):
+        self.reddit = reddit
+        self.display_name = names
+        self.names = {name.lower() for name in names.split('+')}
+        self.stream = None
+
+    def all_submissions(self):
+        return [s for s in self.reddit.submissions.values() if s.subreddit.display_name.lower() in self.names]
+
+    def all_comments(self):
+        return sorted((c for s in self.all_submissions() for c in s.all_comments),
+                      key=lambda c: c.created_utc, reverse=True)
+
+    def hot(self, limit=100):
+        return self.reddit.paginate('hot', sorted(self.all_submissions(), key=lambda s: s.num_comments, reverse=True), limit)
+
+    def new(self, limit=100):
+        return self.reddit.paginate('new', sorted(self.all_submissions(), key=lambda s: s.created_utc, reverse=True), limit)
+
+    def rising(self, limit=100):
+        return self.reddit.paginate('rising', sorted(self.all_submissions(), key=lambda s: s.num_comments / (time.time() - s.created_utc + 1), reverse=True), limit)
+
+    def controversial(self, limit=100):
+        return self.reddit.paginate('controversial', sorted(self.all_submissions(), key=lambda s: s.id), limit)
+
+    def top(self, limit=100):
+        return self.hot(limit)
+
+    def comments(self, limit=100):
+        return self.reddit.paginate('subreddit_comments', self.all_comments(), limit)
+
+
+class FakeReddit:
+    def __init__(self, seed=0, username='NippyBrutalBot'):
+        self.random = random.Random(seed)
+        self.username = username
+        self.calls = Counter()
+        self.subreddits = {}
+        self.submissions = {}
+        self.comments_by_id = {}
+        self.ids = itertools.count(36 ** 5)
+        self.user = FakeUser(self, username)
+        self.auth = FakeAuth()
+
+    def request(self, endpoint):
+        self.calls[endpoint] += 1
+
+    def paginate(self, endpoint, items, limit):
+        # listings come in pages of 100 like the real API
+        if limit is None:
+            limit = len(items)
+        items = items[:limit]
+        for page in range(0, max(len(items), 1), 100):
+            self.request(endpoint)
+            for item in items[page:page + 100]:
+                yield item
+
+    def next_id(self):
+        return base36(next(self.ids))
+
+    def redditor(self, name):
+        return FakeRedditor(self, name)
+
+    def subreddit(self, names):
+        subreddit = FakeSubreddit(self, names)
+        subreddit.stream = type('FakeSubredditStream', (), {})()
+        subreddit.stream.comments = FakeStream(self, 'subreddit_comments', subreddit.all_comments).comments
+        subreddit.stream.submissions = FakeStream(self, 'new', lambda: sorted(
+            subreddit.all_submissions(), key=lambda s: s.created_utc, reverse=True)).submissions
+        return subreddit
+
+    def comment(self, id):
+        # lazy in praw, replying to it doesn't fetch anything
+        return self.comments_by_id[id]
+
+    def submission(self, id):
+        return self.submissions[id]
+
+    def info(self, fullnames):
+        fullnames = list(fullnames)
+        for page in range(0, len(fullnames), 100):
+            self.request('info')
+            for fullname in fullnames[page:page + 100]:
+                if fullname.startswith('t1_') and fullname[3:] in self.comments_by_id:
+                    yield self.comments_by_id[fullname[3:]]
+                elif fullname.startswith('t3_') and fullname[3:] in self.submissions:
+                    yield self.submissions[fullname[3:]]
+
+    def add_submission(self, subreddit_name, title, created_utc=None, selftext='', url=None, author='op'):
+        subreddit = FakeSubreddit(self, subreddit_name)
+        created_utc = time.time() if created_utc is None else created_utc
+        submission = FakeSubmission(self, self.next_id(), subreddit, title, created_utc, selftext, url, FakeRedditor(self, author))
+        self.submissions[submission.id] = submission
+        return submission
+
+    def add_comment(self, submission, parent_id, body, author='user', created_utc=None):
+        created_utc = time.time() if created_utc is None else created_utc
+        comment = FakeComment(self, self.next_id(), submission, parent_id, body, FakeRedditor(self, author), created_utc)
+        submission.all_comments.append(comment)
+        self.comments_by_id[comment.id] = comment
+        if not parent_id.startswith('t3_'):
+            self.comments_by_id[parent_id[3:]].replies.append(comment)
+        return comment
+
+    def generate_thread(self, subreddit_name, num_comments, max_depth=10, trigger_density=0.01, chain_density=0.005, created_utc=None):
+        """A submission with num_comments comments nested up to max_depth levels. About
+        trigger_density of them quote one of the triggers and chain_density of them
+        start a Brutal/Savage/Rekt style chain of replies."""
+        rand = self.random
+        created_utc = time.time() - rand.randint(60, 6 * 60 * 60) if created_utc is None else created_utc
+        submission = self.add_submission(subreddit_name, ' '.join(rand.choice(words) for _ in range(8)), created_utc)
+        depths = {}
+        comments = []
+        while len(comments) < num_comments:
+            parent = rand.choice(comments) if comments and rand.random() < 0.8 else None
+            if parent is not None and depths[parent.id] >= max_depth:
+                parent = None
+            depth = depths[parent.id] + 1 if parent is not None else 0
+            parent_id = parent.name if parent is not None else submission.name
+            author = 'user{}'.format(rand.randint(0, num_comments // 4 + 1))
+            created = created_utc + len(comments)
+            roll = rand.random()
+            if roll < chain_density and num_comments - len(comments) >= 3:
+                for word in rand.choice(chains):
+                    comment = self.add_comment(submission, parent_id, word + '.', author, created)
+                    depths[comment.id] = depth
+                    comments.append(comment)
+                    parent_id, depth = comment.name, depth + 1
+                continue
+            if roll < chain_density + trigger_density:
+                body = rand.choice(triggers)
+            else:
+                body = ' '.join(rand.choice(words) for _ in range(rand.randint(3, 30)))
+            comment = self.add_comment(submission, parent_id, body, author, created)
+            depths[comment.id] = depth
+            comments.append(comment)
+        return submission
+
+    def generate_subreddit(self, subreddit_name, num_submissions, comments_per_submission, **thread_options):
+        return [self.generate_thread(subreddit_name, comments_per_submission, **thread_options) for _ in range(num_submissions)]
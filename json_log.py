@@ -0,0 +1,109 @@
+"""Background logging for the bot. log() and log_error() only put the message on a queue,
+a listener thread formats it and writes it out, so file I/O never runs on the thread that
+matches and replies. Messages are str.format templates with their arguments, formatted
+on the listener thread; arguments and fields that are callables (e.g. comment.permalink)
+are only called there too, so they must only format. Attributes of praw objects can load
+over the network and are read before logging. Files get one JSON object per line and
+rotate by size; without files, plain text goes to the console like before."""
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+logger = logging.getLogger('nippybot')
+logger.propagate = False
+listener = None
+# arguments of the last setup() and the process that made it, a forked worker starts its own listener
+settings = ()
+owner = None
+
+
+def resolve(value):
+    return value() if callable(value) else value
+
+
+class Message:
+    __slots__ = ('template', 'args', 'fields')
+
+    def __init__(self, template, args, fields):
+        self.template = template
+        self.args = args
+        self.fields = fields
+
+    def __str__(self):
+        if not self.args:
+            return str(self.template)
+        return self.template.format(*[resolve(arg) for arg in self.args])
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': round(record.created, 3), 'level': record.levelname.lower(), 'message': str(record.msg)}
+        if isinstance(record.msg, Message):
+            entry.update((key, resolve(value)) for key, value in record.msg.fields.items())
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        if record.levelno >= logging.ERROR:
+            return time.strftime("%a %Y-%m-%d %H:%M:%S - ", time.localtime(record.created)) + str(record.msg)
+        return str(record.msg)
+
+
+class DeferredQueueHandler(QueueHandler):
+    # QueueHandler formats the record before queueing it, the listener thread does that here instead
+    def prepare(self, record):
+        return record
+
+
+def handler(filename, stream, max_bytes, backups):
+    if filename:
+        target = RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        target.setFormatter(JsonFormatter())
+    else:
+        target = logging.StreamHandler(stream)
+        target.setFormatter(TextFormatter())
+    return target
+
+
+def setup(log_file=None, error_file=None, max_bytes=10 * 2 ** 20, backups=5):
+    """Starts the listener thread, replacing the one from an earlier setup(). log_file
+    gets everything below ERROR and error_file the rest, None writes to stdout/stderr."""
+    global listener, settings, owner
+    stop()
+    settings, owner = (log_file, error_file, max_bytes, backups), os.getpid()
+    out = handler(log_file, sys.stdout, max_bytes, backups)
+    out.addFilter(lambda record: record.levelno < logging.ERROR)
+    err = handler(error_file, sys.stderr, max_bytes, backups)
+    err.setLevel(logging.ERROR)
+    messages = queue.SimpleQueue()
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    logger.addHandler(DeferredQueueHandler(messages))
+    logger.setLevel(logging.INFO)
+    listener = QueueListener(messages, out, err, respect_handler_level=True)
+    listener.start()
+
+
+def stop():
+    # writes out what's still queued and closes the files
+    global listener
+    if listener is not None and owner == os.getpid():
+        listener.stop()
+        for target in listener.handlers:
+            target.close()
+        listener = None
+
+
+def log(level, template, args, fields):
+    if listener is None or owner != os.getpid():
+        setup(*settings)
+    logger.log(level, Message(template, args, fields))
+
+
+atexit.register(stop)
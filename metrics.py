@@ -0,0 +1,126 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from itertools import groupby
+from urllib.parse import urlparse
+
+id_in_path = re.compile(r'/(comments|user|r)/[^/]+')
+
+
+def endpoint_name(url):
+    # /r/Dota2/comments/abc123/ -> /r/{}/comments/{}, so requests are grouped by endpoint and not by thing
+    path = id_in_path.sub(lambda match: '/{}/{{}}'.format(match[1]), urlparse(url).path.rstrip('/'))
+    return path or '/'
+
+
+def timed(stage):
+    # times a method of an object that has a metrics attribute as the given stage
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.time(stage):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Metrics:
+    """Counters, gauges and per stage timings for one bot run. Stages are timed with
+    `with metrics.time('match'):`, and everything can be exported as Prometheus text or
+    JSON at the end of a cycle. Safe to update from the fetch threads."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.timings = defaultdict(float)
+            self.runs = defaultdict(int)
+            self.counters = defaultdict(int)
+            self.gauges = {}
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.timings[stage] += elapsed
+                self.runs[stage] += 1
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += amount
+
+    def counter(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def ratio(self, name, hits, misses):
+        self.set(name, hits / (hits + misses) if hits + misses else 0)
+
+    def to_prometheus(self, prefix='nippybot'):
+        def labels(pairs):
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs) + '}' if pairs else ''
+
+        # every metric family is one block under its own TYPE line, strict parsers reject interleaved samples
+        lines = []
+
+        def family(name, kind, samples):
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.extend('{}{} {}'.format(name, labels(pairs), value) for pairs, value in samples)
+
+        with self.lock:
+            stages = sorted(self.timings.items())
+            if stages:
+                family(prefix + '_stage_seconds', 'counter', [((('stage', stage),), '{:.6f}'.format(seconds)) for stage, seconds in stages])
+                family(prefix + '_stage_runs', 'counter', [((('stage', stage),), self.runs[stage]) for stage, _ in stages])
+            for name, samples in groupby(sorted(self.counters.items()), key=lambda item: item[0][0]):
+                family('{}_{}_total'.format(prefix, name), 'counter', [(pairs, value) for (_, pairs), value in samples])
+            for name, samples in groupby(sorted(self.gauges.items()), key=lambda item: item[0][0]):
+                family('{}_{}'.format(prefix, name), 'gauge', [(pairs, value) for (_, pairs), value in samples])
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        def key(name, pairs):
+            return name + ''.join('[{}={}]'.format(k, v) for k, v in pairs)
+
+        with self.lock:
+            return {'started': self.started,
+                    'finished': time.time(),
+                    'stages': {stage: {'seconds': seconds, 'runs': self.runs[stage]} for stage, seconds in self.timings.items()},
+                    'counters': {key(*k): v for k, v in self.counters.items()},
+                    'gauges': {key(*k): v for k, v in self.gauges.items()}}
+
+    def write(self, json_file=None, prometheus_file=None):
+        # written to a temporary file of this process's own first, so readers never see half a file
+        # and processes writing at the same time don't replace each other's temporary file
+        for filename, text in ((json_file, lambda: json.dumps(self.to_dict(), indent=2, sort_keys=True)),
+                               (prometheus_file, self.to_prometheus)):
+            if filename:
+                directory, name = os.path.split(filename)
+                fd, temp = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory or '.')
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        f.write(text())
+                    # mkstemp makes it private, metric files are read by other users (e.g. node_exporter)
+                    os.chmod(temp, 0o644)
+                    os.replace(temp, filename)
+                except BaseException:
+                    os.remove(temp)
+                    raise
+
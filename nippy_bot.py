@@ -1,52 +1,95 @@
 from __future__ import print_function
-import winsound
-import praw
 import os
 import time
-import re
-import sys
-import sqlite3
+import threading
 import configparser
 import content_matching
-from datetime import datetime
+import database
+import dispatcher
+import json_log
+import logging
+import metrics
+import rules
+import scheduler
+import sweeper
+import token_cache
+from metrics import timed
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 #sql commands
 select_comment_with_id = 'SELECT ID FROM comments WHERE ID = ?'
-insert_comment = 'INSERT INTO comments (ID, PERMALINK, DATE_ADDED, VALID) VALUES (?, ?, ?, ?)'
-insert_to_reply = 'INSERT INTO to_reply (ID, RESPONSE) VALUES (?, ?)'
-select_to_reply = 'SELECT ID, RESPONSE FROM to_reply'
+insert_comment = 'INSERT OR IGNORE INTO comments (ID, PERMALINK, DATE_ADDED, VALID) VALUES (?, ?, ?, ?)'
+mark_comment_valid = 'UPDATE comments SET VALID = 1 WHERE ID = ?'
 select_to_reply_with_id = 'SELECT ID FROM to_reply WHERE ID = ?'
-delete_to_reply = 'DELETE FROM to_reply WHERE ID = ?'
-
-stdout = sys.stdout
-stderr = sys.stderr
-
-def log(*args, **kwargs):
-    print(*args, file=stdout, **kwargs)
-
-def log_error(*args, **kwargs):
-    print(time.strftime("%a %Y-%m-%d %H:%M:%S -", time.localtime()), *args, file=stderr, **kwargs)
-
-def match_regex(content, pattern, sanitizer=None, max_size=0, ignore_case=True):
-    def sanitize(string, sanitizer=None):
-        if sanitizer:
-            return re.sub(sanitizer, '', string)
-        else:
-            return string
-
-    flags = re.IGNORECASE if ignore_case else 0
-    if max_size > 0 and len(content) > max_size:
-        return None
-    match = re.search(pattern, content, flags)
-    if match:
-        return sanitize(match[0], sanitizer=sanitizer)
-    else:
-        return None
+select_watermarks = 'SELECT ID, NUM_COMMENTS, NEWEST_COMMENT FROM submissions'
+insert_watermark = 'INSERT OR REPLACE INTO submissions (ID, NUM_COMMENTS, NEWEST_COMMENT, LAST_SCANNED) VALUES (?, ?, ?, ?)'
+select_all_logged_ids = 'SELECT ID FROM comments UNION ALL SELECT ID FROM to_reply'
+create_seen_lookup = 'CREATE TEMP TABLE IF NOT EXISTS seen_lookup (ID VARCHAR(10) PRIMARY KEY NOT NULL)'
+clear_seen_lookup = 'DELETE FROM seen_lookup'
+insert_seen_lookup = 'INSERT OR IGNORE INTO seen_lookup (ID) VALUES (?)'
+select_logged_ids = ('SELECT l.ID FROM seen_lookup l JOIN comments c ON c.ID = l.ID '
+                     'UNION SELECT l.ID FROM seen_lookup l JOIN to_reply r ON r.ID = l.ID')
+delete_cycle = 'DELETE FROM cycle WHERE WORKER = ?'
+insert_cycle = 'INSERT INTO cycle (WORKER, POSITION, ID, STARTED) VALUES (?, ?, ?, ?)'
+delete_old_cycles = 'DELETE FROM cycle WHERE STARTED < ?'
+select_cycle_workers = "SELECT DISTINCT WORKER FROM cycle WHERE WORKER LIKE 'worker-%'"
+select_cycle = 'SELECT ID FROM cycle WHERE WORKER = ? ORDER BY POSITION'
+delete_cycle_item = 'DELETE FROM cycle WHERE WORKER = ? AND ID = ?'
+
+def log(message, *args, **fields):
+    # formatted and written on the logging thread, see json_log.py
+    json_log.log(logging.INFO, message, args, fields)
+
+def log_error(message, *args, **fields):
+    json_log.log(logging.ERROR, message, args, fields)
+
+def beep(frequency, duration):
+    # winsound only exists on Windows
+    try:
+        import winsound
+    except ImportError:
+        return
+    winsound.Beep(frequency, duration)
+
+def seconds(value):
+    # products like "24 * 60 * 60" from nippy_bot.cfg
+    result = 1
+    for factor in value.split('*'):
+        result *= int(factor)
+    return result
+
+def prefetch(func, items, workers):
+    # runs func over items on a bounded thread pool and yields (item, result) in the original order
+    if workers <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= workers * 2:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+def author_name(thing):
+    # read here and not on the logging thread, praw attributes may load over the network
+    return thing.author.name if thing.author is not None else None
+
+def is_submission(thing):
+    return thing.name.startswith('t3_')
 
 class NippyBot:
     sql_creation = 'create_db.sql'
     sql_clean = 'clean_db.sql'
     valid_categories = ['hot', 'new', 'top', 'controversial', 'rising']
+    # listings sorted newest first, once one item is too old all the following ones are too
+    time_ordered_categories = ['new']
     default_category = 'hot'
 
     def __init__(self, bot_name='NippyBrutalBot',
@@ -58,7 +101,15 @@ class NippyBot:
                  db_file='database.db',
                  reset_database=False,
                  sleep_delay=1800,
-                 verbose=False):
+                 fetch_workers=4,
+                 verbose=False,
+                 reddit=None,
+                 metrics_file=None,
+                 prometheus_file=None,
+                 worker_name='main',
+                 rules_file='rules.json',
+                 cache_file=None,
+                 token_file=None):
         # setting variables
         self.bot_name = bot_name.lower()
         self.dry_run = dry_run
@@ -68,74 +119,137 @@ class NippyBot:
         self.post_age_limit = post_age_limit
         self.reset_database = reset_database
         self.sleep_delay = sleep_delay
+        self.fetch_workers = fetch_workers
         self.verbose = verbose
-        # connecting to reddit
-        self.reddit = praw.Reddit(praw_bot_name)
+        self.metrics_file = metrics_file
+        self.prometheus_file = prometheus_file
+        self.worker_name = worker_name
+        self.rules_file = rules_file
+        self.token_file = token_file
+        self.metrics = metrics.Metrics()
+        # praw and prawcore take a while to import, they're only loaded when a real Reddit instance is made
+        self.cache = None
+        if cache_file:
+            # GET responses are kept on disk, see response_cache.py
+            import response_cache
+            self.cache = response_cache.ResponseCache(cache_file)
+        # connecting to reddit (or using the given stand-in, e.g. fake_reddit.FakeReddit)
+        self.make_reddit = None
+        if reddit is None:
+            import praw
+            import response_cache
+            self.make_reddit = lambda: praw.Reddit(praw_bot_name, requestor_class=response_cache.CachingRequestor,
+                                                   requestor_kwargs={'metrics': self.metrics, 'cache': self.cache})
+            reddit = self.make_reddit()
+            if token_file and token_cache.load(reddit, token_file):
+                self.metrics.increment('oauth_token', source='cache')
+        self.reddit = reddit
+        # praw isn't thread safe, fetch threads use Reddit instances of their own (see thread_reddit)
+        self.owner_thread = threading.get_ident()
+        self.thread_local = threading.local()
 
         self.comments_checked, self.comments_matched, self.comments_replied, self.comments_saved = 0, 0, 0, 0
-
-        self.reply_terms = {"gfycat.com/BrutalSavageRekt": 0,
-                            "gfycat.com/NippyKindLangur": 1,
-                            "NippyKindLangur": 1,
-                            "BrutalSavageRekt": 0,
-                            "Rekt": 0,
-                            "Langur": 1}
-        nip = "gfycat.com/NippyKindLangur"
-        bru = "gfycat.com/BrutalSavageRekt"
-        self.reply_regexes = {"gfycat.com/BrutalSavageRekt": nip,
-                              "gfycat.com/NippyKindLangur": bru,
-                              "NippyKindLangur": bru,
-                              "BrutalSavageRekt": nip,
-                              "Rekt": nip,
-                              "Langur": bru}
-        self.reply_terms = dict((k.lower(), v) for k, v in self.reply_terms.items())
-        self.reply_regexes = dict((k.lower(), v) for k, v in self.reply_regexes.items())
-        self.replies = ["https://gfycat.com/NippyKindLangur", "https://gfycat.com/BrutalSavageRekt"]
+        self.comment_index = content_matching.CommentIndex(reddit=self.reddit)
+        self.thread_chains = content_matching.ThreadChains()
+        # match results of the current cycle, reused by validation and replies
+        self.match_cache = content_matching.MatchCache()
+        # submissions seen past post_age_limit, they can't become fresh again. A dict in insertion order,
+        # the oldest entries are dropped past max_stale_submissions
+        self.stale_submissions = {}
+        self.max_stale_submissions = 10000
 
         self.setup_db(self.db_file, self.reset_database)
         self.setup_matchers()
+        self.dispatcher = dispatcher.ReplyDispatcher(self)
+        self.sweeper = sweeper.ReplySweeper(self)
 
     def setup_matchers(self):
-        brutal_nippy = "Brutal{0}Savage{0}Rekt{0}|Nippy{0}Kind{0}Langur{0}".format("[.,\s]*")
-        url = "gfycat.com/(BrutalSavageRekt|NippyKindLangur)"
-
-        simple_matcher = content_matching.ContentMatcher(patterns=[(url, None, 0), (brutal_nippy, "[.,\s]", 100)])
-        chain_matcher1 = content_matching.ChainContentMatcher(patterns=[(x + "[.,\s]*", "[.,\s]", 15) for x in ["Rekt", "Savage", "Brutal"]])
-        chain_matcher2 = content_matching.ChainContentMatcher(patterns=[(x + "[.,\s]*", "[.,\s]", 15) for x in ["Langur", "Kind", "Nippy"]])
-
-        self.comment_matchers = [simple_matcher, chain_matcher1, chain_matcher2]
-        self.submission_matchers = [(brutal_nippy, "[.,\s]", 0), (brutal_nippy, "[.,\s]", 0), (url, None, 0)]
-
+        # trigger vocabulary comes from the rule pack, see rules.py
+        self.rules = rules.RulePack(self.rules_file)
+        self.apply_rules()
+
+    def apply_rules(self):
+        self.comment_matchers = self.rules.comment_matchers
+        self.submission_matchers = self.rules.submission_matchers
+        self.chain_analyzer = content_matching.ChainAnalyzer(self.comment_matchers.matchers)
+
+    def reload_rules(self):
+        try:
+            if self.rules.reload_if_changed():
+                self.apply_rules()
+                if self.verbose:
+                    log("Reloaded rules from {} (version {}).".format(self.rules_file, self.rules.version))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log_error("Could not reload rules from {}, keeping the current ones. [{}]".format(self.rules_file, e))
 
     def setup_db(self, filename, reset_database=False):
         # connecting to database
-        self.connection = sqlite3.connect(filename)
+        self.connection = database.connect(filename)
+        self.connection.set_trace_callback(lambda statement: self.metrics.increment('sqlite_queries'))
         self.c = self.connection.cursor()
+        # log rows are buffered and written in one transaction at each flush()
+        self.writer = database.WriteBuffer(self.connection)
 
-        # create tables if they don't exist
-        with open(self.sql_creation) as f:
-            self.c.executescript(f.read())
-            self.connection.commit()
+        # create tables and apply schema migrations the database doesn't have yet, an up to date
+        # database is recognized by its version alone
+        if database.schema_version(self.connection) < database.latest_version:
+            with open(self.sql_creation) as f:
+                database.migrate(self.connection, f.read())
 
+        self.snapshot_file = None if filename == ':memory:' else filename + '.seen'
         if reset_database:
             self.reset_db()
 
+        self.warm_seen_ids()
+
+    def warm_seen_ids(self, rebuild=False):
+        # every ID already in comments or to_reply, so most lookups never reach the database. They come
+        # from the snapshot the previous run saved (database.SeenIds), or from the tables without one
+        if rebuild:
+            self.seen_ids.clear()
+        else:
+            self.seen_ids = database.SeenIds(self.snapshot_file)
+        if not len(self.seen_ids):
+            self.c.execute(select_all_logged_ids)
+            self.seen_ids.update(row[0] for row in self.c.fetchall())
+
     def reset_db(self):
         with open(self.sql_clean) as f:
             self.c.executescript(f.read())
             self.connection.commit()
+        self.seen_ids = database.SeenIds(self.snapshot_file)
+        self.seen_ids.clear()
+
+    def maintain_db(self, retention=None, interval=24 * 60 * 60):
+        # anything older than the freshness window can't be seen again, twice the window is kept to be safe
+        if retention is None:
+            retention = 2 * self.post_age_limit
+        now = time.time()
+        if now - database.get_meta(self.connection, 'last_maintenance', 0) < interval:
+            return None
+        self.flush()
+        pruned = database.prune(self.connection, now - retention)
+        database.set_meta(self.connection, 'last_maintenance', int(now))
+        if pruned:
+            # the snapshot still has the pruned IDs
+            self.warm_seen_ids(rebuild=True)
+        if self.verbose:
+            log("Pruned {} logged comments older than {} seconds.".format(pruned, retention))
+        return pruned
 
-    def is_submission_fresh(self, submission):
-        submission_date = datetime.fromtimestamp(submission.created_utc)
-        limit_date = datetime.fromtimestamp(time.time() - self.post_age_limit)
-        return submission_date > limit_date
+    def is_submission_fresh(self, submission, cutoff=None):
+        if cutoff is None:
+            cutoff = time.time() - self.post_age_limit
+        return submission.created_utc > cutoff
 
     #section_limits should be arguments with the key being the category (e.g. hot, new, top) and value the limit of posts, e.g hot=5, new=10
+    @timed('fetch')
     def get_submissions(self, sub_names=None, **section_limits):
         if sub_names is None:
             sub_names = self.subreddits_to_search
         subs = self.reddit.subreddit(sub_names)
-        result = set()
+        result, seen = [], set()
+        cutoff = time.time() - self.post_age_limit
 
         if not section_limits:
             section_limits[NippyBot.default_category] = self.posts_limit
@@ -143,83 +257,128 @@ class NippyBot:
         for section, limit in section_limits.items():
             if section in NippyBot.valid_categories:
                 func = getattr(subs, section)
-                result = result.union({submission for submission in func(limit=limit) if self.is_submission_fresh(submission)})
-
-        return list(result)
+                time_ordered = section in NippyBot.time_ordered_categories
+                for submission in func(limit=limit):
+                    # deduped by fullname, overlapping categories return the same submissions
+                    if submission.name in seen:
+                        continue
+                    stale = submission.name in self.stale_submissions
+                    if not stale and self.is_submission_fresh(submission, cutoff):
+                        seen.add(submission.name)
+                        result.append(submission)
+                        continue
+                    if not stale:
+                        self.mark_stale(submission)
+                    if time_ordered:
+                        # everything after it is older, this stops the listing from loading any more pages
+                        break
+
+        return result
+
+    def mark_stale(self, submission):
+        self.stale_submissions[submission.name] = None
+        if len(self.stale_submissions) > self.max_stale_submissions:
+            del self.stale_submissions[next(iter(self.stale_submissions))]
 
     def get_comments_from_sub(self, sub_names, limit):
-        return list(self.reddit.subreddit(sub_names).comments(limit=limit))
+        return [content_matching.CommentRecord.from_comment(comment)
+                for comment in self.reddit.subreddit(sub_names).comments(limit=limit)]
 
     def parse_comment(self, comment):
-        content = content_matching.CommentContent(comment)
-        for matcher in self.comment_matchers:
-            content.reset()
-            result = matcher.match(content)
-            if result:
-                return result
+        # most comments are turned down by the literal check, that's cheaper than a cache lookup
+        if not self.comment_matchers.accepts(comment.body):
+            return None
+        return self.match_cache.get((comment.id, self.rules.version), lambda: self.match_comment(comment))
 
+    def match_comment(self, comment):
+        content = content_matching.CommentContent(comment, self.comment_index)
+        return self.comment_matchers.match(content, self.thread_chains.get(comment))
 
     def parse_submission(self, submission):
-        if submission.is_self:
-            text_post_matcher = self.submission_matchers[0]
-            result = match_regex(submission.selftext, text_post_matcher[0], sanitizer=text_post_matcher[1], max_size=text_post_matcher[2])
-            if result:
-                return result
-        title_matcher = self.submission_matchers[1]
-        result1 = match_regex(submission.title, title_matcher[0], sanitizer=title_matcher[1], max_size=title_matcher[2])
-        result2 = None
-
-        if not submission.is_self:
-            url_matcher = self.submission_matchers[2]
-            result2 = match_regex(submission.url, url_matcher[0], sanitizer=url_matcher[1], max_size=url_matcher[2])
-
-        if result1 and result2: #if post has a match on title and links to it, don't reply
-            return None
-        if result1:
-            return result1
-        return result2
+        return self.match_cache.get((submission.name, self.rules.version), lambda: content_matching.match_submission(
+            submission, self.comment_matchers, self.submission_matchers))
 
     def is_comment_logged(self, comment):
+        if comment.id in self.seen_ids:
+            return True
         self.c.execute(select_comment_with_id, [comment.id])
         if self.c.fetchone() is None:
             self.c.execute(select_to_reply_with_id, [comment.id])
-            return self.c.fetchone() is not None
+            logged = self.c.fetchone() is not None
         else:
-            return True
+            logged = True
+        if logged:
+            self.seen_ids.add(comment.id)
+        return logged
+
+    def logged_ids(self, ids):
+        # resolves a whole batch of IDs against comments and to_reply with a single query
+        ids = set(ids)
+        logged = ids & self.seen_ids
+        unknown = ids - logged
+        self.metrics.increment('seen_lookups', len(logged), source='memory')
+        self.metrics.increment('seen_lookups', len(unknown), source='database')
+        if unknown:
+            self.c.execute(create_seen_lookup)
+            self.c.execute(clear_seen_lookup)
+            self.c.executemany(insert_seen_lookup, [(i,) for i in unknown])
+            self.c.execute(select_logged_ids)
+            found = {row[0] for row in self.c.fetchall()}
+            self.c.execute(clear_seen_lookup)
+            # the temp table writes opened a transaction, left open its read snapshot would make the next claim() fail
+            self.connection.commit()
+            self.seen_ids.update(found)
+            logged.update(found)
+        return logged
 
     def is_submission_logged(self, submission):
+        if submission.name in self.seen_ids:
+            return True
         self.c.execute(select_comment_with_id, [submission.name])
         return self.c.fetchone() is not None
 
     def log_comment(self, comment, valid=True):
         if not self.dry_run:
-            self.c.execute(insert_comment, [comment.id, comment.permalink(), time.time(), 1 if valid else 0])
+            self.writer.add(insert_comment, [comment.id, comment.permalink(), time.time(), 1 if valid else 0])
+            self.seen_ids.add(comment.id)
+
+    def log_submission(self, submission, valid=True):
+        if not self.dry_run:
+            self.writer.add(insert_comment, [submission.name, submission.permalink, time.time(), 1 if valid else 0])
+            self.seen_ids.add(submission.name)
 
-    def log_submission(self, submission):
+    def log_sent(self, thing_id):
+        # replies are logged as not valid before sending, a row stays that way if the reply never went out
         if not self.dry_run:
-            self.c.execute(insert_comment, [submission.name, submission.permalink, time.time(), 1])
+            self.writer.add(mark_comment_valid, [thing_id])
+
+    def parent_of(self, comment):
+        return self.comment_index.parent(comment)
 
     def is_comment_reply_to_bot(self, comment):
         if comment.is_root:
             return False
-        parent = comment.parent()
-        return parent.author and parent.author.name.lower() == self.bot_name
+        parent = self.parent_of(comment)
+        return parent is not None and (parent.author_name or '').lower() == self.bot_name
 
+    @timed('validate')
     def validate_comments(self, comments_to_reply, matches):
         invalid = set()
+        self.resolve_parents(comments_to_reply)
+        parents = {comment: self.parent_of(comment) for comment in comments_to_reply if not comment.is_root}
+        logged_parents = self.logged_ids(parent.id for parent in parents.values() if parent is not None)
         for comment in comments_to_reply:
-            has_parent = not comment.is_root
-            if self.is_comment_reply_to_bot(comment) or (has_parent and self.is_comment_logged(comment.parent())):
+            parent = parents.get(comment)
+            if self.is_comment_reply_to_bot(comment) or (parent is not None and parent.id in logged_parents):
                 invalid.add(comment)
-            elif has_parent:
-                parent = comment.parent()
+            elif parent is not None:
                 if not parent.body:
                     continue
                 match = self.parse_comment(parent)
                 if match:
                     match = match[0][0]
                     regex = self.regex_for_reply_for_match(match)
-                    possible = re.search(regex, comment.body, re.IGNORECASE)
+                    possible = content_matching.compile_pattern(regex).search(comment.body)
                     if possible:
                         invalid.add(comment)
                         invalid.add(parent)
@@ -229,35 +388,32 @@ class NippyBot:
     def reply_for_match(self, match):
         if match is None:
             return None
-        return self.replies[self.reply_terms[match.lower()]]
+        return self.rules.reply_for(match)
 
     def regex_for_reply_for_match(self, match):
         if match is None:
             return None
-        return self.reply_regexes[match.lower()]
-
-    def reply_later(self, comment, reply):
-        self.c.execute(insert_to_reply, [comment.id, reply])
+        return self.rules.answered_by_for(match)
+
+    def reply_later(self, thing, reply):
+        # comments are queued by ID and submissions by fullname, see ReplyDispatcher.enqueue
+        thing_id = thing.name if is_submission(thing) else thing.id
+        self.dispatcher.enqueue(thing, reply)
+        self.release(thing_id)
+        self.seen_ids.add(thing_id)
         if self.verbose:
-            log("Saving comment [[{}]] to reply later, reply: \'{}\'".format(comment.id, reply))
+            log("Saving [[{}]] to reply later, reply: \'{}\'", thing_id, reply, event='queued', thing=thing_id)
+
+    def live(self):
+        # reads that decide what gets sent or deleted skip the response cache
+        return self.cache.bypassed() if self.cache is not None else nullcontext()
 
     def reply_to_old_comments(self):
-        self.c.execute(select_to_reply)
-        comments = self.c.fetchall()
-        #TODO: validate if old_comments should still be replied to
-        replied = set()
-        if comments and self.verbose:
-            log("Replying to old comments. (There are {} comments to reply to).".format(len(comments)))
-        for comment_info in comments:
-            comment = self.reddit.comment(comment_info[0])
-            try:
-                self.reply_to_comment(comment, comment_info[1])
-                self.c.execute(delete_to_reply, [comment.id])
-                self.log_comment(comment, True)
-                replied.add(comment)
-            except praw.exceptions.PRAWException as e:
-                return replied
-        self.connection.commit()
+        # due replies go out freshest first while the rate limit allows, failures are rescheduled with backoff
+        with self.live():
+            replied = self.dispatcher.dispatch()
+        if replied and self.verbose:
+            log("Replied to {} old comments. ({} still waiting).".format(len(replied), self.dispatcher.queue_size()))
         return replied
 
     def reply_to_comment(self, comment, reply=None):
@@ -270,9 +426,15 @@ class NippyBot:
             if reply is None:
                 return
         if self.verbose:
-            log("Replying to {0}'s comment with {1}. Original comment permalink: https://reddit.com{2}".format(comment.author.name, reply, comment.permalink()))
+            log("Replying to {0}'s comment with {1}. Original comment permalink: https://reddit.com{2}",
+                comment.author_name, reply, comment.permalink, event='reply', comment=comment.id)
         if not self.dry_run:
-            comment.reply(reply)
+            with self.metrics.time('reply'):
+                # a lazy praw Comment with just the ID is enough to reply, nothing is fetched
+                sent = self.reddit.comment(comment.id).reply(reply)
+            if sent is not None:
+                self.sweeper.track(sent, comment)
+            self.metrics.increment('replies_sent', kind='comment')
 
     def reply_to_submission(self, submission, reply=None):
         if reply is None:
@@ -284,45 +446,86 @@ class NippyBot:
             if reply is None:
                 return
         if self.verbose:
-            log("Replying to {0}'s post with {1}. Original post permalink: https://reddit.com{2}".format(submission.author.name, reply, submission.url))
+            log("Replying to {0}'s post with {1}. Original post permalink: https://reddit.com{2}",
+                author_name(submission), reply, submission.url, event='reply', submission=submission.id)
         if not self.dry_run:
-            submission.reply(reply)
+            with self.metrics.time('reply'):
+                sent = submission.reply(reply)
+            if sent is not None:
+                self.sweeper.track(sent, submission)
+            self.metrics.increment('replies_sent', kind='submission')
 
     def delete_comments(self, limit=100, from_subreddits=None, below_threshold=None):
-        if from_subreddits:
-            from_subreddits = [sub.lower() for sub in from_subreddits]
-        me = self.reddit.user.me()
-        comments = list(me.comments.new(limit=limit))
-        deleted = set()
-        for comment in comments:
-            sub_matches = not bool(from_subreddits) or comment.subreddit.display_name.lower() in from_subreddits
-            if sub_matches:
-                threshold_met = below_threshold is None or comment.score < below_threshold
-                if threshold_met:
-                    comment.delete()
-                    deleted.add(comment)
-        return deleted
+        # without a threshold the newest limit replies are all deleted. With one, only replies young
+        # enough for their score to still change are checked, see sweeper.py
+        with self.live():
+            if below_threshold is None:
+                return self.sweeper.delete_newest(limit, from_subreddits)
+            self.sweeper.backfill()
+            return self.sweeper.sweep(below_threshold, from_subreddits)
 
 
     def get_comments(self, submission):
-        all_comments = submission.comments
+        return self.get_tree(submission)[0]
+
+    @timed('expand')
+    def get_tree(self, submission):
+        # the tree is loaded on a Submission of its own and kept as CommentRecords, so the praw
+        # objects are released here instead of staying attached to the listing's submission.
+        # Returns the records and the comment count the tree was loaded with, a tree from the
+        # response cache can be older than the listing
+        thread = self.thread_reddit().submission(id=submission.id)
+        all_comments = thread.comments
         all_comments.replace_more(limit=None, threshold=0)
-        flat_comments = all_comments.list()
-        return flat_comments
+        return [content_matching.CommentRecord.from_comment(comment) for comment in all_comments.list()], thread.num_comments
+
+    def thread_reddit(self):
+        # the bot's Reddit instance on the thread that made the bot, a separate one sharing its token
+        # on each fetch thread. A stand-in passed as reddit is used by every thread
+        if self.make_reddit is None or threading.get_ident() == self.owner_thread:
+            return self.reddit
+        reddit = getattr(self.thread_local, 'reddit', None)
+        if reddit is None:
+            reddit = self.thread_local.reddit = self.make_reddit()
+            token_cache.share(self.reddit, reddit)
+        return reddit
+
+    def get_watermarks(self):
+        self.c.execute(select_watermarks)
+        return {row[0]: (row[1], row[2]) for row in self.c.fetchall()}
+
+    def get_comments_if_changed(self, submission, watermarks):
+        # threads whose comment count didn't change since the last scan aren't downloaded again
+        watermark = watermarks.get(submission.name)
+        if watermark is not None and watermark[0] == submission.num_comments:
+            return None
+        return self.get_tree(submission)
 
+    def update_watermark(self, submission, comments, newest=0, num_comments=None):
+        # num_comments is the count of the scanned tree, a stale tree then doesn't hide newer comments
+        # behind the listing's count and the thread is loaded again next cycle
+        if not self.dry_run:
+            newest = max([int(comment.created_utc) for comment in comments] + [newest])
+            if num_comments is None:
+                num_comments = submission.num_comments
+            self.writer.add(insert_watermark, [submission.name, num_comments, newest, time.time()])
+
+    @timed('match')
     def get_comments_to_reply(self, comments):
         matches = dict()
         to_reply = set()
         comments_checked, comments_matched = 0, 0
+        # already handled comments are dropped up front, before any matching runs
+        logged = self.logged_ids(comment.id for comment in comments if comment.author_name is not None)
         for comment in comments:
             #TODO handle better comments that were deleted
-            if comment.author is None:
+            if comment.author_name is None:
                 continue
             self.comments_checked += 1
             comments_checked += 1
 
             #comment not made or replied already by bot
-            if comment.author.name.lower() != self.bot_name and not self.is_comment_logged(comment):
+            if comment.author_name.lower() != self.bot_name and comment.id not in logged:
                 match = self.parse_comment(comment)
                 if match is not None:
                     matches[comment.id] = match
@@ -332,124 +535,371 @@ class NippyBot:
 
         return matches, to_reply, comments_checked, comments_matched
 
-    def parse_comments(self, comments, commit=False):
-        comments_checked, comments_matched, comments_replied, comments_saved = 0, 0, 0, 0
+    def load_thread(self, comments):
+        # parents are resolved from the loaded comments before going to the network, and reply
+        # chains are found for the whole thread in one pass instead of per comment
+        self.comment_index = content_matching.CommentIndex(comments, self.reddit)
+        self.thread_chains = self.chain_analyzer.analyze(comments)
+        # comments without their ancestors (e.g. from a subreddit's comment listing): the parents a
+        # chain still needs are loaded together, one level of the chain per round
+        for _ in range(self.chain_analyzer.depth):
+            if not self.thread_chains.missing:
+                break
+            self.resolve(self.thread_chains.missing)
+            self.thread_chains = self.chain_analyzer.analyze(list(self.comment_index.comments.values()))
+
+    def resolve(self, fullnames):
+        fetched = self.comment_index.resolve(fullnames)
+        self.metrics.increment('resolved_comments', fetched)
+        return fetched
+
+    def resolve_parents(self, comments):
+        return self.resolve(comment.parent_id for comment in comments if not comment.is_root)
+
+    def parse_comments(self, comments, commit=False, thread=None):
+        self.load_thread(comments if thread is None else thread)
+
+        matches, to_reply, comments_checked, comments_matched = self.get_comments_to_reply(comments)
+        comments_replied, comments_saved = self.reply_to_matches(matches, to_reply)
+        self.metrics.increment('comment_index', self.comment_index.hits, result='hit')
+        self.metrics.increment('comment_index', self.comment_index.misses, result='miss')
+
+        if commit:
+            self.flush()
+
+        return (comments_checked, comments_matched, comments_replied, comments_saved)
 
-        matches, to_reply, checked, matched = self.get_comments_to_reply(comments)
-        comments_checked += checked
-        comments_matched += matched
+    def reply_to_matches(self, matches, to_reply):
+        comments_replied, comments_saved = 0, 0
 
         # remove comments already replied to or that are replies to something the bot would've replied
         valid_comments, invalid_comments = self.validate_comments(comments_to_reply=to_reply, matches=matches)
 
+        logged = self.logged_ids(comment.id for comment in invalid_comments)
         for comment in invalid_comments:
-            if not self.is_comment_logged(comment):
+            if comment.id not in logged:
                 self.log_comment(comment, False)
             if self.verbose:
-                log("Would've replied to {0}'s comment but it either was already replied to or is a reply. Original comment permalink: https://reddit.com{1}".format(comment.author, comment.permalink()))
+                log("Would've replied to {0}'s comment but it either was already replied to or is a reply. Original comment permalink: https://reddit.com{1}",
+                    comment.author_name, comment.permalink, event='invalid', comment=comment.id)
 
         for comment in valid_comments:
             match = matches[comment.id]
             reply = self.reply_for_match(match[0][0])
+            if not self.claim(comment.id):
+                # another worker process already took this one
+                continue
+            if not self.dispatcher.can_send():
+                # out of rate limit budget, queueing is cheaper than a request that will be refused
+                self.reply_later(comment, reply)
+                self.comments_saved += 1
+                comments_saved += 1
+                continue
+            # the log rows are committed before the reply is sent, a crash in between costs one reply instead of sending it twice
+            self.log_comment(comment, valid=False)
+            for m in match[1:]:
+                #logging parent comments to the one being answered
+                self.log_comment(m[1], valid=False)
+            self.flush()
             try:
                 self.reply_to_comment(comment, reply)
-                self.log_comment(comment)
-                for m in match[1:]:
-                    #logging parent comments to the one being answered
-                    self.log_comment(m[1], valid=False)
+                self.log_sent(comment.id)
                 self.comments_replied += 1
                 comments_replied += 1
-            except praw.exceptions.PRAWException as e:
+            except dispatcher.api_error() as e:
                 if self.verbose:
-                    log_error("Error when trying to reply to comment, saving for later. Comment permalink = https://reddit.com{}. [{}]".format(comment.permalink(), e))
+                    log_error("Error when trying to reply to comment, saving for later. Comment permalink = https://reddit.com{}. [{}]",
+                              comment.permalink, e, event='reply_failed', comment=comment.id)
                 self.reply_later(comment, reply)
                 self.comments_saved += 1
                 comments_saved += 1
 
-        if commit:
-            self.connection.commit()
+        return comments_replied, comments_saved
 
-        return (comments_checked, comments_matched, comments_replied, comments_saved)
+    def reply_to_submission_match(self, submission, match):
+        if not self.claim(submission.name):
+            return False
+        reply = self.reply_for_match(match)
+        if not self.dispatcher.can_send():
+            self.reply_later(submission, reply)
+            return False
+        # logged before sending like comment replies, see reply_to_matches
+        self.log_submission(submission, valid=False)
+        self.flush()
+        try:
+            self.reply_to_submission(submission, reply)
+        except dispatcher.api_error() as e:
+            if self.verbose:
+                log_error("Error when trying to reply to submission, saving for later. Submission id = {}. [{}]",
+                          submission.id, e, event='reply_failed', submission=submission.id)
+            delay = dispatcher.rate_limit_delay(e)
+            if delay is not None:
+                self.dispatcher.bucket.pause(delay)
+            self.reply_later(submission, reply)
+            return False
+        self.log_sent(submission.name)
+        return True
+
+    def claim(self, thing_id):
+        # atomic claim in the shared database, so two workers never reply to the same thing
+        if self.dry_run:
+            return True
+        return database.claim(self.connection, thing_id, self.worker_name)
+
+    def release(self, thing_id):
+        # a queued reply is claimed again by whichever worker's dispatcher sends it
+        if not self.dry_run:
+            self.writer.add(database.release_claim, [thing_id, self.worker_name])
+
+    def start_cycle(self, submissions):
+        # the cycle's submissions are stored as this worker's cursor, each one is removed once it's scanned
+        if self.dry_run:
+            return
+        started = int(time.time())
+        with self.connection:
+            self.connection.execute(delete_cycle, [self.worker_name])
+            self.connection.executemany(insert_cycle, [[self.worker_name, position, submission.name, started]
+                                                       for position, submission in enumerate(submissions)])
+
+    def resume_cycle(self, max_age=None):
+        # submissions an interrupted cycle didn't get to and that are still fresh, an empty list when the last
+        # cycle finished. A cursor older than max_age (two sleep_delays, it missed a whole cycle) is dropped
+        if max_age is None:
+            max_age = 2 * self.sleep_delay
+        if not self.dry_run:
+            with self.connection:
+                self.connection.execute(delete_old_cycles, [int(time.time() - max_age)])
+        self.c.execute(select_cycle, [self.worker_name])
+        fullnames = [row[0] for row in self.c.fetchall()]
+        if not fullnames:
+            return []
+        cutoff = time.time() - self.post_age_limit
+        return [submission for submission in self.reddit.info(fullnames=fullnames) if self.is_submission_fresh(submission, cutoff)]
+
+    def drop_cycles(self, workers):
+        # cursors of supervisor workers that aren't in the current plan, e.g. after the pool shrank
+        if self.dry_run:
+            return
+        self.c.execute(select_cycle_workers)
+        with self.connection:
+            for (worker,) in self.c.fetchall():
+                if worker not in workers:
+                    self.connection.execute(delete_cycle, [worker])
+
+    def checkpoint(self, submission, cycle):
+        # the submission's log rows, watermark and cursor entry are committed together
+        if cycle and not self.dry_run:
+            self.writer.add(delete_cycle_item, [self.worker_name, submission.name])
+        self.flush()
 
     def parse_submissions(self, submissions, check_comments=True):
+        self.reload_rules()
+        self.match_cache.clear()
         comments_checked, comments_matched, comments_replied, comments_saved, submissions_replied = 0, 0, 0, 0, 0
-        for submission in submissions:
+        # comment trees are loaded on a thread pool, matching and database writes stay on this thread
+        if check_comments:
+            submissions = list(submissions)
+            self.start_cycle(submissions)
+            watermarks = self.get_watermarks()
+            trees = prefetch(lambda submission: self.get_comments_if_changed(submission, watermarks), submissions, self.fetch_workers)
+        else:
+            trees = ((submission, None) for submission in submissions)
+
+        for submission, tree in trees:
+            comments, num_comments = tree if tree is not None else (None, None)
             if not self.is_submission_logged(submission):
                 submission_match = self.parse_submission(submission)
-                if submission_match:
-                    self.reply_to_submission(submission, self.reply_for_match(submission_match))
-                    self.log_submission(submission)
+                if submission_match and self.reply_to_submission_match(submission, submission_match):
                     submissions_replied += 1
 
-            if not check_comments:
-                continue
+            if comments is not None:
+                # only comments posted since the last scan are checked, the rest of the tree is still used for parents
+                newest = watermarks[submission.name][1] if submission.name in watermarks else 0
+                new_comments = [comment for comment in comments if comment.created_utc >= newest]
+                result = self.parse_comments(new_comments, commit=False, thread=comments)
+                self.update_watermark(submission, comments, newest, num_comments)
 
-            comments = self.get_comments(submission)
+                comments_checked += result[0]
+                comments_matched += result[1]
+                comments_replied += result[2]
+                comments_saved += result[3]
 
-            result = self.parse_comments(comments, commit=False)
+            self.checkpoint(submission, check_comments)
 
-            comments_checked += result[0]
-            comments_matched += result[1]
-            comments_replied += result[2]
-            comments_saved += result[3]
-
-        self.connection.commit()
         return (comments_checked, comments_matched, comments_replied, comments_saved, submissions_replied)
 
+    def stream_items(self, sub_names=None, pause_after=-1):
+        # new comments and submissions from the live streams, with None whenever both streams ran dry
+        if sub_names is None:
+            sub_names = self.subreddits_to_search
+        subs = self.reddit.subreddit(sub_names)
+        streams = [subs.stream.comments(pause_after=pause_after), subs.stream.submissions(pause_after=pause_after)]
+        while True:
+            for stream in streams:
+                for item in stream:
+                    if item is None:
+                        break
+                    yield item if is_submission(item) else content_matching.CommentRecord.from_comment(item)
+            yield None
+
+    def dedupe_stream(self, items):
+        for item in items:
+            if item is None:
+                yield item
+            elif is_submission(item):
+                if not self.is_submission_logged(item):
+                    yield item
+            elif item.author_name is not None:
+                self.comments_checked += 1
+                if item.author_name.lower() != self.bot_name and not self.is_comment_logged(item):
+                    yield item
+
+    def match_stream(self, items):
+        for item in items:
+            if item is None:
+                yield item, None
+                continue
+            if is_submission(item):
+                match = self.parse_submission(item)
+            else:
+                self.load_thread([item])
+                match = self.parse_comment(item)
+            if match:
+                if not is_submission(item):
+                    self.comments_matched += 1
+                yield item, match
+
+    def run_stream(self, sub_names=None, pause_after=-1, retry_delay=30, max_retry_delay=15 * 60, sleep=time.sleep):
+        # fetch -> dedupe -> match, then validate and reply to each match as soon as it arrives. Reddit
+        # errors are logged, a failed item is skipped and a failed stream is made again after a delay
+        # that doubles up to max_retry_delay while the failures go on
+        delay = retry_delay
+        while True:
+            try:
+                for item, match in self.match_stream(self.dedupe_stream(self.stream_items(sub_names, pause_after))):
+                    try:
+                        self.handle_stream_item(item, match)
+                    except dispatcher.api_error() as e:
+                        log_error("Error when handling a stream item, skipping it. [{}]", e, event='stream_item_failed')
+                    delay = retry_delay
+            except dispatcher.api_error() as e:
+                log_error("Stream failed, starting it again in {} seconds. [{}]", delay, e, event='stream_failed')
+                self.flush()
+                sleep(delay)
+                delay = min(delay * 2, max_retry_delay)
+
+    def handle_stream_item(self, item, match):
+        if item is None:
+            # the streams ran dry, this ends a cycle
+            self.match_cache.clear()
+            self.flush()
+            self.reload_rules()
+            self.reply_to_old_comments()
+            self.maintain_db()
+            self.write_metrics()
+            return
+        if is_submission(item):
+            self.reply_to_submission_match(item, match)
+        else:
+            self.reply_to_matches({item.id: match}, {item})
+        self.flush()
+
+    def run_scheduled(self, subreddits=None, min_interval=30):
+        # polls every subreddit on its own interval, between min_interval and sleep_delay seconds
+        return scheduler.PollingScheduler(self, subreddits, min_interval=min_interval).run()
+
+    @timed('db')
+    def flush(self):
+        self.writer.flush()
+
+    def write_metrics(self):
+        self.metrics.set('reply_queue_depth', self.dispatcher.queue_size())
+        self.metrics.set('write_buffer_depth', len(self.writer))
+        self.metrics.set('seen_ids', len(self.seen_ids))
+        self.metrics.ratio('comment_index_hit_ratio', self.metrics.counter('comment_index', result='hit'),
+                           self.metrics.counter('comment_index', result='miss'))
+        self.metrics.ratio('match_cache_hit_ratio', self.match_cache.hits, self.match_cache.misses)
+        self.metrics.ratio('seen_lookups_hit_ratio', self.metrics.counter('seen_lookups', source='memory'),
+                           self.metrics.counter('seen_lookups', source='database'))
+        self.metrics.write(self.metrics_file, self.prometheus_file)
+
     def finish(self):
+        self.flush()
         self.connection.close()
+        self.seen_ids.save()
+        if self.token_file and self.reddit is not None:
+            token_cache.save(self.reddit, self.token_file)
+        if self.cache is not None:
+            self.cache.close()
+
+def bot_options(variables):
+    # NippyBot arguments from the [variables] section of nippy_bot.cfg
+    metrics_file = variables['MetricsFile']
+    prometheus_file = variables['PrometheusFile']
+    cache_file = variables['ResponseCache']
+    token_file = variables['TokenCache']
+    return dict(bot_name=variables['BotName'].lower(),
+                praw_bot_name='bot1',
+                subreddits_to_search=variables['Subs'],
+                posts_limit=int(variables['MaxPosts']),
+                dry_run=variables.getboolean('DryRun'),
+                post_age_limit=seconds(variables['MaxPostAge']),
+                db_file=variables['DataBaseFileName'],
+                reset_database=variables.getboolean('ResetDB'),
+                sleep_delay=seconds(variables['SleepDelay']),
+                metrics_file=None if metrics_file == 'None' else metrics_file,
+                prometheus_file=None if prometheus_file == 'None' else prometheus_file,
+                cache_file=None if cache_file == 'None' else cache_file,
+                token_file=None if token_file == 'None' else token_file)
+
+def log_options(variables, worker_name=None):
+    # json_log.setup() arguments from the config, a worker process gets files of its own (logs/out.worker-0.txt)
+    # since size based rotation can't be shared between processes
+    def filename(value):
+        if value == 'None':
+            return None
+        if worker_name is None:
+            return value
+        root, extension = os.path.splitext(value)
+        return '{}.{}{}'.format(root, worker_name, extension)
+    return dict(log_file=filename(variables['LogFile']), error_file=filename(variables['ErrorLogFile']),
+                max_bytes=int(variables['LogMaxBytes']), backups=int(variables['LogBackups']))
 
 if __name__ == '__main__':
-    winsound.Beep(700, 90)
+    beep(700, 90)
     configs_file = 'nippy_bot.cfg'
     c = configparser.ConfigParser()
     c.read(configs_file)
 
-    bot_name = c['variables']['BotName'].lower()
-    dry_run = eval(c['variables']['DryRun'])
-    subreddits_to_search = c['variables']['Subs']
-    posts_limit = int(c['variables']['MaxPosts'])
-    db_file = c['variables']['DataBaseFileName']
-    post_age_limit = eval(c['variables']['MaxPostAge'])
-    reset_database = eval(c['variables']['ResetDB'])
-    sleep_delay = eval(c['variables']['SleepDelay'])
+    options = bot_options(c['variables'])
+    subreddits_to_search = options['subreddits_to_search']
     score_threshold = int(c['variables']['DeleteBelowScore'])
-    out = c['variables']['LogFile']
-    err = c['variables']['ErrorLogFile']
-
-    if out != 'None':
-        stdout = open(out, 'a')
-
-    if err != 'None':
-        stderr = open(err, 'a')
+    json_log.setup(**log_options(c['variables']))
 
     log(time.strftime("Start time: %a %Y-%m-%d %H:%M:%S", time.localtime()))
 
-    bot = NippyBot(bot_name=bot_name,
-                   praw_bot_name='bot1',
-                   subreddits_to_search=subreddits_to_search,
-                   posts_limit=posts_limit,
-                   dry_run=dry_run,
-                   post_age_limit=post_age_limit,
-                   db_file=db_file,
-                   reset_database=reset_database,
-                   sleep_delay=sleep_delay,
-                   verbose=True)
-
-    limit = 10
-    log("Deleting comments below threshold. (limit={}, threshold={})".format(limit, score_threshold))
-    deleted = bot.delete_comments(limit=limit, from_subreddits=None, below_threshold=score_threshold)
+    bot = NippyBot(verbose=True, **options)
+
+    log("Deleting comments below threshold. (threshold={})".format(score_threshold))
+    deleted = bot.delete_comments(from_subreddits=None, below_threshold=score_threshold)
     for comment in deleted:
-        log("Deleted comment {} with score of {}.".format(comment.body, comment.score))
+        log("Deleted comment {} with score of {}.", comment.body, comment.score, event='deleted', comment=comment.id)
+
+    bot.reply_to_old_comments()
 
     log("Searching for new comments to reply on /r/{}.".format(subreddits_to_search))
-    submissions = bot.get_submissions(sub_names=subreddits_to_search, hot=50, rising=15, controversial=15)
+    submissions = bot.resume_cycle()
+    if submissions:
+        log("Resuming the interrupted cycle, {} submissions left.".format(len(submissions)))
+    else:
+        submissions = bot.get_submissions(sub_names=subreddits_to_search, hot=50, rising=15, controversial=15)
     result = bot.parse_submissions(submissions)
+    bot.maintain_db()
+    bot.write_metrics()
     log("All operations done. {} submissions checked. {} comments checked. {} comments matched. {} comments invalidated. {} comments replied to. {} comments saved for later. {} submissions replied to.".format(len(submissions), result[0], result[1], result[2], result[2], result[3], result[4]))
     log(time.strftime("End time: %a %Y-%m-%d %H:%M:%S", time.localtime()))
     log("---------------------------------")
     bot.finish()
 
-    stdout.close()
-    stderr.close()
-    winsound.Beep(250, 150)
+    json_log.stop()
+    beep(250, 150)
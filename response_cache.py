@@ -0,0 +1,196 @@
+"""prawcore requestors for the bot. InstrumentedRequestor counts the requests praw makes
+and CachingRequestor also answers GET requests from an optional on-disk ResponseCache,
+so dry runs and repeated debugging runs don't download the same listings and comment
+trees again. Only the status, a few headers and the body of a response are stored, never
+the request (it carries the OAuth token). Responses are kept in a SQLite file for a time
+that depends on the endpoint, and the least recently used ones are evicted once the file
+holds more than max_bytes of responses. Imported only when a real praw.Reddit is made,
+prawcore is slow to import."""
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import prawcore
+import requests
+import metrics
+
+create_responses = '''CREATE TABLE IF NOT EXISTS http_responses (
+    KEY TEXT PRIMARY KEY NOT NULL,
+    ENDPOINT TEXT NOT NULL,
+    EXPIRES INTEGER NOT NULL,
+    LAST_USED REAL NOT NULL,
+    SIZE INTEGER NOT NULL,
+    STATUS INTEGER NOT NULL,
+    HEADERS TEXT NOT NULL,
+    BODY BLOB NOT NULL
+)'''
+# pickled responses from before, they carried the request with its Authorization header
+drop_pickled_responses = 'DROP TABLE IF EXISTS responses'
+create_last_used_index = 'CREATE INDEX IF NOT EXISTS http_responses_last_used ON http_responses (LAST_USED)'
+select_response = 'SELECT STATUS, HEADERS, BODY FROM http_responses WHERE KEY = ? AND EXPIRES > ?'
+touch_response = 'UPDATE http_responses SET LAST_USED = ? WHERE KEY = ?'
+insert_response = ('INSERT OR REPLACE INTO http_responses (KEY, ENDPOINT, EXPIRES, LAST_USED, SIZE, STATUS, HEADERS, BODY) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?)')
+delete_expired = 'DELETE FROM http_responses WHERE EXPIRES <= ?'
+select_total_size = 'SELECT COALESCE(SUM(SIZE), 0) FROM http_responses'
+select_least_used = 'SELECT KEY, SIZE FROM http_responses ORDER BY LAST_USED LIMIT ?'
+delete_response = 'DELETE FROM http_responses WHERE KEY = ?'
+
+# the only headers stored with a body. x-ratelimit-* are left out on purpose, prawcore's rate
+# limiter reads them from every response and a stale copy would make it wait for an old reset
+kept_headers = ('content-type', 'etag', 'last-modified')
+
+# seconds a response stays fresh by metrics.endpoint_name, listings change quickly and threads slowly
+default_ttls = {
+    '/r/{}/new': 30,
+    '/r/{}/comments': 30,
+    '/r/{}/hot': 60,
+    '/r/{}/rising': 60,
+    '/r/{}/controversial': 300,
+    '/r/{}/top': 300,
+    '/comments/{}': 300,
+    '/api/morechildren': 300,
+    '/api/v1/me': 60 * 60,
+}
+
+
+def cache_key(url, params=None):
+    return url + '?' + json.dumps(params or {}, sort_keys=True, default=str)
+
+
+def submission_age(response):
+    # age of the submission a /comments/{} response belongs to, None when it can't be read
+    try:
+        return time.time() - response.json()[0]['data']['children'][0]['data']['created_utc']
+    except (ValueError, LookupError, TypeError):
+        return None
+
+
+def rebuild_response(url, status, headers, body):
+    response = requests.Response()
+    response.url = url
+    response.status_code = status
+    response.reason = 'OK'
+    response.headers.update(headers)
+    response._content = body
+    response.encoding = 'utf-8'
+    return response
+
+
+class ResponseCache:
+    def __init__(self, filename, ttls=None, default_ttl=60, max_bytes=64 * 2 ** 20, max_thread_ttl=60 * 60):
+        self.ttls = dict(default_ttls, **(ttls or {}))
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.max_thread_ttl = max_thread_ttl
+        # reads that decide what the bot sends or deletes set this to go to Reddit, see bypassed()
+        self.bypass = False
+        # the fetch threads share the connection
+        self.lock = threading.Lock()
+        if not os.path.exists(filename):
+            # readable by the bot's user only, like the token file
+            os.close(os.open(filename, os.O_WRONLY | os.O_CREAT, 0o600))
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(drop_pickled_responses)
+            self.connection.execute(create_responses)
+            self.connection.execute(create_last_used_index)
+            self.connection.execute(delete_expired, [int(time.time())])
+        self.size = self.connection.execute(select_total_size).fetchone()[0]
+
+    def ttl(self, endpoint, response):
+        ttl = self.ttls.get(endpoint, self.default_ttl)
+        if endpoint == '/comments/{}':
+            # old threads barely change, a day old one is kept for max_thread_ttl
+            age = submission_age(response)
+            if age is not None:
+                ttl = min(self.max_thread_ttl, max(ttl, age / 24))
+        return ttl
+
+    def get(self, key):
+        # (status, headers, body) of a fresh response, None on a miss
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(select_response, [key, int(now)]).fetchone()
+            if row is None:
+                return None
+            with self.connection:
+                self.connection.execute(touch_response, [now, key])
+        return row[0], json.loads(row[1]), row[2]
+
+    def put(self, key, endpoint, response):
+        if response.status_code != 200:
+            return
+        now = time.time()
+        headers = json.dumps({name: response.headers[name] for name in kept_headers if name in response.headers})
+        body = response.content
+        size = len(headers) + len(body)
+        with self.lock, self.connection:
+            self.connection.execute(insert_response, [key, endpoint, int(now + self.ttl(endpoint, response)), now, size,
+                                                      response.status_code, headers, body])
+            self.size += size
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self, batch=100):
+        # least recently used first until the responses fit in max_bytes again
+        while self.size > self.max_bytes:
+            rows = self.connection.execute(select_least_used, [batch]).fetchall()
+            if not rows:
+                self.size = 0
+                break
+            for key, size in rows:
+                self.connection.execute(delete_response, [key])
+                self.size -= size
+                if self.size <= self.max_bytes:
+                    break
+
+    @contextmanager
+    def bypassed(self):
+        bypass, self.bypass = self.bypass, True
+        try:
+            yield
+        finally:
+            self.bypass = bypass
+
+    def close(self):
+        self.connection.close()
+
+
+class InstrumentedRequestor(prawcore.Requestor):
+    """prawcore requestor that counts every HTTP request by method and endpoint.
+    Passed to praw.Reddit as requestor_class with requestor_kwargs={'metrics': metrics}."""
+    def __init__(self, *args, metrics=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = metrics
+
+    def request(self, method, url, *args, **kwargs):
+        if self.metrics is not None:
+            self.metrics.increment('api_requests', method=method, endpoint=metrics.endpoint_name(url))
+            with self.metrics.time('http'):
+                return super().request(method, url, *args, **kwargs)
+        return super().request(method, url, *args, **kwargs)
+
+
+class CachingRequestor(InstrumentedRequestor):
+    """InstrumentedRequestor that answers GET requests from a ResponseCache when it has
+    a fresh copy, passed to praw.Reddit like its parent with cache=ResponseCache(...) in
+    requestor_kwargs. Without a cache it only counts requests."""
+    def __init__(self, *args, cache=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache = cache
+
+    def request(self, method, url, *args, **kwargs):
+        if self.cache is None or self.cache.bypass or method != 'GET':
+            return super().request(method, url, *args, **kwargs)
+        key = cache_key(url, kwargs.get('params'))
+        cached = self.cache.get(key)
+        if self.metrics is not None:
+            self.metrics.increment('response_cache', result='miss' if cached is None else 'hit')
+        if cached is None:
+            response = super().request(method, url, *args, **kwargs)
+            self.cache.put(key, metrics.endpoint_name(url), response)
+            return response
+        return rebuild_response(url, *cached)
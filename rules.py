@@ -0,0 +1,91 @@
+"""Trigger rules loaded from a rule pack (rules.json by default). Each meme in the pack
+has the reply to post, the terms its matches can produce, the literals its triggers
+contain and its patterns:
+
+    link    pattern for links to the meme (comments and submission URLs)
+    phrase  [pattern, sanitizer, max_size] for the written out phrase (comments, titles, self posts)
+    chain   [pattern, sanitizer, max_size] per level for reply chains, the comment itself first
+
+All memes are compiled into one content_matching.IndexedMatcherSet, so a comment only
+runs the patterns of the memes whose literals it contains."""
+import json
+import os
+import re
+import content_matching
+
+
+def check_patterns(meme):
+    # every pattern is compiled when the pack loads, a typo fails the load instead of a later match
+    entries = [(meme['link'], None)] if meme.get('link') else []
+    entries += [meme['phrase']] if meme.get('phrase') else []
+    entries += meme.get('chain') or []
+    for entry in entries:
+        for pattern in entry[:2]:
+            try:
+                content_matching.compile_pattern(pattern)
+            except re.error as e:
+                raise ValueError("bad pattern {!r} in rule {}: {}".format(pattern, meme.get('name', meme['terms'][0]), e))
+
+
+class RulePack:
+    def __init__(self, filename):
+        self.filename = filename
+        self.mtime = None
+        self.version = 0
+        self.load()
+
+    def load(self):
+        mtime = os.stat(self.filename).st_mtime
+        with open(self.filename) as f:
+            memes = json.load(f)['memes']
+        self.compile(memes)
+        self.mtime = mtime
+        self.version += 1
+
+    def reload_if_changed(self):
+        # a broken pack raises and leaves the rules that were loaded before in place
+        if os.stat(self.filename).st_mtime == self.mtime:
+            return False
+        self.load()
+        return True
+
+    def compile(self, memes):
+        links, phrases, chains = [], [], []
+        replies, answered_by = {}, {}
+        for meme in memes:
+            check_patterns(meme)
+            literals = meme['literals']
+            if meme.get('link'):
+                links.append((meme['link'], literals))
+            if meme.get('phrase'):
+                phrases.append((tuple(meme['phrase']), literals))
+            if meme.get('chain'):
+                chains.append(([tuple(level) for level in meme['chain']], literals))
+            for term in meme['terms']:
+                replies[term.lower()] = meme['reply']
+                answered_by[term.lower()] = meme.get('answered_by') or re.escape(meme['reply'].split('://')[-1])
+
+        # links win over phrases and phrases over chains, like the order of the old hard-coded matchers
+        keyed = [(content_matching.ContentMatcher(patterns=[(link, None, 0)]), literals) for link, literals in links]
+        keyed += [(content_matching.ContentMatcher(patterns=[phrase]), literals) for phrase, literals in phrases]
+        keyed += [(content_matching.ChainContentMatcher(patterns=levels), literals) for levels, literals in chains]
+        comment_matchers = content_matching.IndexedMatcherSet(keyed)
+
+        # submissions use one combined pattern per phrase sanitizer, so every match is cleaned up by its own meme's
+        by_sanitizer = {}
+        for (pattern, sanitizer, _), _ in phrases:
+            by_sanitizer.setdefault(sanitizer, []).append(pattern)
+        phrase = [(content_matching.compile_pattern('|'.join('(?:{})'.format(p) for p in patterns)), sanitizer, 0)
+                  for sanitizer, patterns in by_sanitizer.items()]
+        link = content_matching.compile_pattern('|'.join('(?:{})'.format(l) for l, _ in links) or '(?!)')
+        submission_matchers = [phrase, phrase, [(link, None, 0)]]
+
+        # swapped in together so a reload never leaves half old and half new rules
+        self.comment_matchers, self.submission_matchers = comment_matchers, submission_matchers
+        self.replies, self.answered_by = replies, answered_by
+
+    def reply_for(self, match):
+        return self.replies.get(match.lower())
+
+    def answered_by_for(self, match):
+        return self.answered_by.get(match.lower())
@@ -0,0 +1,28 @@
+from nippy_bot import NippyBot, log
+import json_log
+import time
+
+subs = 'dota2+globaloffensive+overwatch+hearthstone+leagueoflegends'
+subs = 'skull0801devtest'
+
+json_log.setup('logs/out_scheduled.txt', 'logs/err_scheduled.txt')
+
+bot = NippyBot(bot_name="NippyBrutalBot",
+               praw_bot_name='bot1',
+               subreddits_to_search=subs,
+               post_age_limit=60*60*3,
+               db_file='database.db',
+               verbose=True,
+               dry_run=True)
+
+log(time.strftime("Start time: %a %Y-%m-%d %H:%M:%S", time.localtime()))
+log("Polling new comments in /r/{}".format(subs))
+try:
+    bot.run_scheduled()
+except KeyboardInterrupt:
+    pass
+log("Polling stopped. {} comments checked. {} comments matched. {} comments replied to. {} comments saved for later.".format(bot.comments_checked, bot.comments_matched, bot.comments_replied, bot.comments_saved))
+log(time.strftime("End time: %a %Y-%m-%d %H:%M:%S", time.localtime()))
+log("---------------------------------")
+bot.finish()
+json_log.stop()
@@ -0,0 +1,184 @@
+"""Runs the trigger rules over a newline delimited JSON dump of comments and/or submissions
+(e.g. the Pushshift monthly dumps, plain or compressed with gzip, bz2, xz or zstd), to tune
+rules and look for false positives without going through the API. Chunks of the dump are
+matched on a process pool; reply chains whose earlier links are in another chunk are
+finished here, from the chain candidates of the chunks already scanned. Matches are written
+as JSON lines.
+
+    python scanner.py RC_2017-06.zst --output matches.jsonl --workers 8
+"""
+import argparse
+import bz2
+import gzip
+import io
+import itertools
+import json
+import lzma
+import multiprocessing
+import os
+import sys
+import time
+from collections import Counter
+from types import SimpleNamespace
+import content_matching
+import rules
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+removed_bodies = {'[deleted]', '[removed]'}
+
+# set up once in every worker process by init_worker
+rule_pack = None
+analyzer = None
+
+
+def open_dump(filename):
+    if filename.endswith('.zst'):
+        if zstandard is None:
+            raise SystemExit("Reading .zst dumps needs the zstandard package.")
+        # the Pushshift dumps are compressed with a long window
+        reader = zstandard.ZstdDecompressor(max_window_size=2 ** 31).stream_reader(open(filename, 'rb'))
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    opener = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}.get(os.path.splitext(filename)[1], open)
+    return opener(filename, 'rt', encoding='utf-8')
+
+
+def chunks(lines, size):
+    lines = iter(lines)
+    while True:
+        chunk = list(itertools.islice(lines, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class DumpIndex(content_matching.CommentIndex):
+    # parents come from the dump only, a parent that isn't there ends the chain
+    def parent(self, comment):
+        parent = self.comments.get(comment.parent_id)
+        if parent is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return parent
+
+    def trim(self, size):
+        # oldest first, dumps are sorted by time so those are the least likely parents
+        while len(self.comments) > size:
+            del self.comments[next(iter(self.comments))]
+
+
+def comment_record(item):
+    return content_matching.CommentRecord(item['id'], item['parent_id'], item['link_id'], item.get('author'),
+                                          item.get('body') or '', float(item['created_utc']), item.get('subreddit') or '')
+
+
+def submission_record(item):
+    url = item.get('url') or ''
+    return SimpleNamespace(id=item['id'], name='t3_' + item['id'], title=item.get('title') or '',
+                           selftext=item.get('selftext') or '', url=url, is_self=bool(item.get('is_self')),
+                           author_name=item.get('author'), created_utc=float(item['created_utc']),
+                           subreddit=item.get('subreddit') or '',
+                           permalink=item.get('permalink') or '/comments/{}/'.format(item['id']))
+
+
+def describe(thing, terms, rule_pack):
+    permalink = thing.permalink() if callable(thing.permalink) else thing.permalink
+    return {'kind': 'submission' if thing.name.startswith('t3_') else 'comment',
+            'id': thing.id, 'subreddit': thing.subreddit, 'author': thing.author_name,
+            'created_utc': thing.created_utc, 'permalink': permalink,
+            'match': terms, 'reply': rule_pack.reply_for(terms[0])}
+
+
+def init_worker(rules_file):
+    global rule_pack, analyzer
+    rule_pack = rules.RulePack(rules_file)
+    analyzer = content_matching.ChainAnalyzer(rule_pack.comment_matchers.matchers)
+
+
+def scan_chunk(lines):
+    # (lines, comments, submissions, matches, chain candidates, pending), pending are the comments that
+    # need parents from an earlier chunk to finish a chain
+    comments, submissions, matches = [], 0, []
+    for line in lines:
+        try:
+            item = json.loads(line)
+        except ValueError:
+            continue
+        if 'title' in item:
+            submissions += 1
+            submission = submission_record(item)
+            match = content_matching.match_submission(submission, rule_pack.comment_matchers, rule_pack.submission_matchers)
+            if match:
+                matches.append(describe(submission, [match], rule_pack))
+        elif 'body' in item and item['body'] not in removed_bodies:
+            comments.append(comment_record(item))
+
+    index = DumpIndex(comments)
+    chains = analyzer.analyze(comments)
+    pending = []
+    for comment in comments:
+        if not rule_pack.comment_matchers.accepts(comment.body):
+            continue
+        found = chains.get(comment)
+        match = rule_pack.comment_matchers.match(content_matching.CommentContent(comment, index), found)
+        if match:
+            matches.append(describe(comment, [term for term, _ in match], rule_pack))
+        elif found is None:
+            pending.append(comment)
+    candidates = [comment for comment in comments if analyzer.may_be_ancestor(comment)]
+    return len(lines), len(comments), submissions, matches, candidates, pending
+
+
+def scan(filename, rules_file='rules.json', workers=None, chunk_size=20000, max_ancestors=1000000, output=sys.stdout):
+    pack = rules.RulePack(rules_file)
+    ancestors = DumpIndex()
+    totals = Counter()
+    terms = Counter()
+    start = time.perf_counter()
+    with open_dump(filename) as dump, multiprocessing.Pool(workers, init_worker, (rules_file,)) as pool:
+        # results come back in dump order, so the candidates of every earlier chunk are known here
+        for lines, comments, submissions, matches, candidates, pending in pool.imap(scan_chunk, chunks(dump, chunk_size)):
+            ancestors.add_all(candidates)
+            ancestors.trim(max_ancestors)
+            for comment in pending:
+                match = pack.comment_matchers.match(content_matching.CommentContent(comment, ancestors))
+                if match:
+                    matches.append(describe(comment, [term for term, _ in match], pack))
+            for match in matches:
+                output.write(json.dumps(match) + '\n')
+                terms[match['match'][0].lower()] += 1
+            totals.update(lines=lines, comments=comments, submissions=submissions, matches=len(matches), pending=len(pending))
+    totals['seconds'] = time.perf_counter() - start
+    return totals, terms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dump')
+    parser.add_argument('--rules', default='rules.json')
+    parser.add_argument('--output', help='matches file, standard output by default')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=20000, help='lines per job')
+    parser.add_argument('--max-ancestors', type=int, default=1000000, help='chain candidates kept for later chunks')
+    options = parser.parse_args()
+
+    output = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        totals, terms = scan(options.dump, options.rules, options.workers, options.chunk_size, options.max_ancestors, output)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    seconds = totals['seconds']
+    print("{} lines, {} comments, {} submissions in {:.1f}s ({:.0f} lines/s) with {} workers.".format(
+        totals['lines'], totals['comments'], totals['submissions'], seconds,
+        totals['lines'] / seconds if seconds else 0, options.workers), file=sys.stderr)
+    print("{} matches: {}".format(totals['matches'], ', '.join('{}={}'.format(k, v) for k, v in terms.most_common()) or '-'),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
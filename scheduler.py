@@ -0,0 +1,105 @@
+import heapq
+import time
+
+
+class SubredditSchedule:
+    """Polling state of one subreddit. The interval follows the observed comment arrival
+    rate so roughly target_comments new comments are waiting at each poll, subreddits
+    where the bot finds matches (at least match_threshold per poll, smoothed) are polled
+    twice as often, and the result is clamped to [min_interval, max_interval]."""
+    def __init__(self, name, min_interval, max_interval, target_comments=50, smoothing=0.5, match_threshold=0.5):
+        self.name = name
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_comments = target_comments
+        self.smoothing = smoothing
+        self.match_threshold = match_threshold
+        self.interval = min_interval
+        self.arrival_rate = None
+        self.match_rate = 0.0
+        self.last_poll = None
+        self.newest = 0
+        # IDs of the comments created in the newest second, timestamps are whole seconds and
+        # a comment posted later in that second shows up in the next poll
+        self.newest_ids = set()
+
+    def new_comments(self, comments):
+        return [comment for comment in comments if comment.created_utc > self.newest or
+                (comment.created_utc == self.newest and comment.id not in self.newest_ids)]
+
+    def update(self, new, matched, full_page, now):
+        # new are the comments that arrived since the previous poll
+        if new:
+            newest = max(comment.created_utc for comment in new)
+            if newest != self.newest:
+                self.newest, self.newest_ids = newest, set()
+            self.newest_ids.update(comment.id for comment in new if comment.created_utc == newest)
+        if self.last_poll is None:
+            # first poll, estimate the rate from the timestamps on the page itself
+            span = max(now - min(comment.created_utc for comment in new), 1) if new else self.max_interval
+        else:
+            span = max(now - self.last_poll, 1)
+        rate = len(new) / span
+        if self.arrival_rate is None:
+            self.arrival_rate = rate
+        else:
+            self.arrival_rate = self.smoothing * rate + (1 - self.smoothing) * self.arrival_rate
+        self.match_rate = self.smoothing * (matched / span) + (1 - self.smoothing) * self.match_rate
+
+        if full_page and self.last_poll is not None:
+            # the page was full of new comments, some were probably missed
+            interval = self.interval / 2
+        elif self.arrival_rate > 0:
+            interval = self.target_comments / self.arrival_rate
+        else:
+            interval = self.interval * 2
+        # the smoothed match rate never gets back to 0, it has to promise a match every other poll or so
+        if self.match_rate * interval >= self.match_threshold:
+            interval /= 2
+        self.interval = min(self.max_interval, max(self.min_interval, interval))
+        self.last_poll = now
+
+
+class PollingScheduler:
+    """Polls each subreddit's newest comments on its own adaptive interval and hands them
+    to bot.parse_comments. Busy subreddits are polled often and quiet ones back off up to
+    the bot's sleep_delay."""
+    def __init__(self, bot, subreddits=None, min_interval=30, max_interval=None, limit=100, target_comments=50):
+        self.bot = bot
+        if subreddits is None:
+            subreddits = bot.subreddits_to_search.split('+')
+        if max_interval is None:
+            max_interval = max(bot.sleep_delay, min_interval)
+        self.limit = limit
+        self.schedules = [SubredditSchedule(name, min_interval, max_interval, target_comments) for name in subreddits]
+        self.queue = [(0, index) for index in range(len(self.schedules))]
+        heapq.heapify(self.queue)
+
+    def poll(self, schedule):
+        comments = self.bot.get_comments_from_sub(schedule.name, self.limit)
+        now = time.time()
+        new = schedule.new_comments(comments)
+        result = self.bot.parse_comments(new, commit=True)
+        schedule.update(new, result[1], len(new) >= self.limit, now)
+        self.bot.metrics.set('poll_interval', schedule.interval, subreddit=schedule.name)
+        return result
+
+    def run(self, polls=None, sleep=time.sleep):
+        # polls=None runs until interrupted
+        done = 0
+        while polls is None or done < polls:
+            due, index = heapq.heappop(self.queue)
+            wait = due - time.time()
+            if wait > 0:
+                sleep(wait)
+            schedule = self.schedules[index]
+            # every poll is a cycle of its own for the match cache
+            self.bot.match_cache.clear()
+            self.bot.reload_rules()
+            self.poll(schedule)
+            self.bot.reply_to_old_comments()
+            self.bot.maintain_db()
+            self.bot.write_metrics()
+            heapq.heappush(self.queue, (time.time() + schedule.interval, index))
+            done += 1
+        return done
@@ -0,0 +1,80 @@
+"""Runs one sweep split across worker processes. With at least as many subreddits as
+workers each worker gets its own subreddits, otherwise every worker reads the same
+listings and takes the submissions whose ID falls in its shard. Replies are claimed in
+the shared database first (NippyBot.claim), so no comment is answered twice.
+
+    python supervisor.py --workers 4
+"""
+import argparse
+import configparser
+import multiprocessing
+import time
+import json_log
+from nippy_bot import NippyBot, bot_options, log, log_options
+
+
+def plan(subreddits, workers):
+    # (subreddits, shard, shards) for each worker
+    if len(subreddits) >= workers:
+        return [(subreddits[index::workers], 0, 1) for index in range(workers)]
+    return [(subreddits, index, workers) for index in range(workers)]
+
+
+def in_shard(submission, shard, shards):
+    return int(submission.id, 36) % shards == shard
+
+
+def worker_name(index):
+    return 'worker-{}'.format(index)
+
+
+def run_worker(index, workers, options, log_variables, subreddits, shard, shards, section_limits):
+    if log_variables is not None:
+        json_log.setup(**log_options(log_variables, worker_name(index)))
+    bot = NippyBot(subreddits_to_search='+'.join(subreddits), worker_name=worker_name(index), **options)
+    try:
+        if index == 0:
+            bot.drop_cycles({worker_name(other) for other in range(workers)})
+        # every worker sends from the shared queue, the claims keep them from sending the same reply
+        bot.reply_to_old_comments()
+        submissions = bot.resume_cycle() or [s for s in bot.get_submissions(**section_limits) if in_shard(s, shard, shards)]
+        result = bot.parse_submissions(submissions)
+        return (len(submissions),) + tuple(result)
+    finally:
+        bot.finish()
+        json_log.stop()
+
+
+def supervise(options, workers, log_variables=None, **section_limits):
+    # log_variables are the config settings for log_options(), every worker logs to files of its own
+    options = dict(options)
+    subreddits = options.pop('subreddits_to_search').split('+')
+    # the database is shared, resetting it from every worker would wipe the others' claims
+    options['reset_database'] = False
+    jobs = [(index, workers, options, log_variables, subs, shard, shards, section_limits)
+            for index, (subs, shard, shards) in enumerate(plan(subreddits, workers))]
+    with multiprocessing.Pool(len(jobs)) as pool:
+        results = pool.starmap(run_worker, jobs)
+    return [sum(values) for values in zip(*results)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--config', default='nippy_bot.cfg')
+    args = parser.parse_args()
+
+    c = configparser.ConfigParser()
+    c.read(args.config)
+    options = bot_options(c['variables'])
+    json_log.setup(**log_options(c['variables']))
+    # every worker would write over the same metric files
+    options['metrics_file'] = options['prometheus_file'] = None
+
+    log(time.strftime("Start time: %a %Y-%m-%d %H:%M:%S", time.localtime()))
+    log("Searching for new comments to reply on /r/{} with {} workers.".format(options['subreddits_to_search'], args.workers))
+    result = supervise(options, args.workers, dict(c['variables']), hot=50, rising=15, controversial=15)
+    log("All operations done. {} submissions checked. {} comments checked. {} comments matched. {} comments replied to. {} comments saved for later. {} submissions replied to.".format(*result))
+    log(time.strftime("End time: %a %Y-%m-%d %H:%M:%S", time.localtime()))
+    log("---------------------------------")
+    json_log.stop()
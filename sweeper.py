@@ -0,0 +1,99 @@
+import time
+import content_matching
+import database
+
+insert_reply = 'INSERT OR IGNORE INTO replies (ID, PARENT_ID, SUBREDDIT, CREATED, NEXT_CHECK) VALUES (?, ?, ?, ?, ?)'
+select_due_replies = 'SELECT ID, CREATED, SUBREDDIT FROM replies WHERE DELETED = 0 AND CREATED >= ? AND NEXT_CHECK <= ? ORDER BY NEXT_CHECK'
+update_reply_score = 'UPDATE replies SET SCORE = ?, LAST_CHECKED = ?, NEXT_CHECK = ? WHERE ID = ?'
+insert_reply_score = 'INSERT INTO reply_scores (ID, CHECKED_AT, SCORE) VALUES (?, ?, ?)'
+mark_reply_deleted = 'UPDATE replies SET DELETED = 1 WHERE ID = ?'
+
+
+class ReplySweeper:
+    """Tracks every reply the bot makes and deletes the ones whose score falls below a
+    threshold. A reply is re-checked on an interval that grows with its age, and once it
+    is older than max_age its score has settled and it leaves the sweep. Scores of the
+    due replies are refreshed with reddit.info, batch_size fullnames per request."""
+    def __init__(self, bot, max_age=3 * 24 * 60 * 60, min_interval=10 * 60, max_interval=6 * 60 * 60, batch_size=100):
+        self.bot = bot
+        self.max_age = max_age
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.batch_size = batch_size
+
+    def next_check(self, created, now):
+        # a reply a few minutes old is checked every min_interval, a day old one every max_interval
+        return int(now + min(self.max_interval, max(self.min_interval, (now - created) / 4)))
+
+    def track(self, reply, parent, created=None):
+        created = int(time.time() if created is None else created)
+        self.bot.writer.add(insert_reply, [reply.id, parent.name, content_matching.subreddit_name(parent).lower(),
+                                           created, self.next_check(created, created)])
+
+    def backfill(self, limit=None):
+        # replies made before they were tracked, read once from the account's comment history
+        if self.bot.dry_run or database.get_meta(self.bot.connection, 'replies_backfilled'):
+            return 0
+        now = time.time()
+        count = 0
+        for comment in self.bot.reddit.user.me().comments.new(limit=limit):
+            if comment.created_utc >= now - self.max_age:
+                self.bot.writer.add(insert_reply, [comment.id, comment.parent_id, comment.subreddit.display_name.lower(),
+                                                   int(comment.created_utc), 0])
+                count += 1
+        self.bot.flush()
+        database.set_meta(self.bot.connection, 'replies_backfilled', int(now))
+        return count
+
+    def delete_newest(self, limit=100, from_subreddits=None):
+        # every one of the account's newest limit comments in from_subreddits, nothing is deleted in dry run
+        if from_subreddits:
+            from_subreddits = {sub.lower() for sub in from_subreddits}
+        deleted = []
+        for comment in self.bot.reddit.user.me().comments.new(limit=limit):
+            if from_subreddits and comment.subreddit.display_name.lower() not in from_subreddits:
+                continue
+            if not self.bot.dry_run:
+                comment.delete()
+                self.bot.writer.add(mark_reply_deleted, [comment.id])
+                deleted.append(comment)
+        self.bot.flush()
+        self.bot.metrics.increment('replies_deleted', len(deleted))
+        return deleted
+
+    def due(self, now):
+        self.bot.c.execute(select_due_replies, [now - self.max_age, now])
+        return self.bot.c.fetchall()
+
+    def sweep(self, below_threshold, from_subreddits=None, now=None):
+        # returns the deleted comments below below_threshold, nothing is deleted in dry run
+        if from_subreddits:
+            from_subreddits = {sub.lower() for sub in from_subreddits}
+        now = time.time() if now is None else now
+        due = self.due(now)
+        created = {id: (created, subreddit) for id, created, subreddit in due}
+        scores, updates, deleted, gone = [], [], [], []
+        for start in range(0, len(due), self.batch_size):
+            fullnames = ['t1_' + row[0] for row in due[start:start + self.batch_size]]
+            for comment in self.bot.reddit.info(fullnames=fullnames):
+                reply_created, subreddit = created[comment.id]
+                scores.append([comment.id, int(now), comment.score])
+                updates.append([comment.score, int(now), self.next_check(reply_created, now), comment.id])
+                if comment.author is None:
+                    # removed by someone else, nothing left to check
+                    gone.append(comment.id)
+                    continue
+                sub_matches = not from_subreddits or subreddit in from_subreddits
+                if sub_matches and comment.score < below_threshold and not self.bot.dry_run:
+                    comment.delete()
+                    deleted.append(comment)
+        for params in scores:
+            self.bot.writer.add(insert_reply_score, params)
+        for params in updates:
+            self.bot.writer.add(update_reply_score, params)
+        for id in gone + [comment.id for comment in deleted]:
+            self.bot.writer.add(mark_reply_deleted, [id])
+        self.bot.flush()
+        self.bot.metrics.increment('replies_checked', len(scores))
+        self.bot.metrics.increment('replies_deleted', len(deleted))
+        return deleted
@@ -0,0 +1,61 @@
+"""Reply claims shared by processes on one database file (database.claim, NippyBot.claim).
+
+    python -m pytest test_claims.py
+"""
+import multiprocessing
+import os
+import tempfile
+import unittest
+import database
+import fake_reddit
+from nippy_bot import NippyBot
+
+create_claims = 'CREATE TABLE claims (ID VARCHAR(10) PRIMARY KEY NOT NULL, WORKER VARCHAR(30) NOT NULL, CLAIMED_AT INTEGER NOT NULL)'
+
+
+def claim_all(filename, worker, ids, results):
+    connection = database.connect(filename)
+    results.put((worker, [id for id in ids if database.claim(connection, id, worker)]))
+    connection.close()
+
+
+class ClaimTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'bot.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_processes_claim_disjoint_ids(self):
+        connection = database.connect(self.filename)
+        connection.execute(create_claims)
+        connection.close()
+        ids = ['c{}'.format(n) for n in range(200)]
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=claim_all, args=(self.filename, 'worker-{}'.format(n), ids, results))
+                   for n in range(2)]
+        for worker in workers:
+            worker.start()
+        claimed = dict(results.get(timeout=60) for _ in workers)
+        for worker in workers:
+            worker.join()
+        self.assertEqual(set(claimed['worker-0']) & set(claimed['worker-1']), set())
+        self.assertEqual(set(claimed['worker-0']) | set(claimed['worker-1']), set(ids))
+
+    def test_claim_after_logged_ids(self):
+        # logged_ids must not leave a read transaction open that the next claim() can't upgrade
+        a = NippyBot(reddit=fake_reddit.FakeReddit(), db_file=self.filename, dry_run=False, worker_name='a')
+        b = NippyBot(reddit=fake_reddit.FakeReddit(), db_file=self.filename, dry_run=False, worker_name='b')
+        try:
+            a.logged_ids(['x'])
+            self.assertTrue(b.claim('x'))
+            self.assertTrue(a.claim('y'))
+            self.assertFalse(a.claim('x'))
+        finally:
+            a.connection.close()
+            b.connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
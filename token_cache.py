@@ -0,0 +1,60 @@
+"""Keeps praw's OAuth access token in a file between runs, so a run started by cron uses
+the token of the one before until it expires instead of asking Reddit for a new one.
+praw has no public API for this, the token lives on the authorizer of its session."""
+import json
+import os
+import tempfile
+import time
+
+
+def authorizer(reddit):
+    return getattr(getattr(reddit, '_core', None), '_authorizer', None)
+
+
+def load(reddit, filename, margin=60):
+    # False when there is no token that is still valid for at least margin seconds
+    auth = authorizer(reddit)
+    if auth is None or not os.path.exists(filename):
+        return False
+    try:
+        with open(filename) as f:
+            token = json.load(f)
+        if token['expires'] - margin <= time.time():
+            return False
+        auth.access_token = token['access_token']
+        auth._expiration_timestamp = token['expires']
+        auth.scopes = set(token['scopes'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+    return True
+
+
+def save(reddit, filename):
+    auth = authorizer(reddit)
+    if auth is None or not getattr(auth, 'access_token', None):
+        return
+    token = {'access_token': auth.access_token,
+             'expires': auth._expiration_timestamp,
+             'scopes': sorted(auth.scopes or [])}
+    # mkstemp makes the file readable by the bot's user only (it's a bearer token), and gives every
+    # process its own temp file, supervisor workers save at the same time
+    directory, name = os.path.split(filename)
+    fd, temp = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(token, f)
+        os.replace(temp, filename)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+def share(source, target):
+    # gives target the token source already has, so another Reddit instance doesn't ask for one of its own
+    auth, other = authorizer(source), authorizer(target)
+    if auth is None or other is None or not getattr(auth, 'access_token', None):
+        return False
+    other.access_token = auth.access_token
+    other._expiration_timestamp = auth._expiration_timestamp
+    other.scopes = set(auth.scopes or [])
+    return True